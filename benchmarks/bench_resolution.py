@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#
+# times how the plugin's file resolution scales, using synthetic PHP
+# projects of different sizes and layouts
+#
+# usage:
+#
+#   python benchmarks/bench_resolution.py [--sizes 1000,50000,500000]
+#       [--layouts psr4,legacy] [--samples 100] [--output results.json]
+#       [--keep]
+#
+# the results are written out as JSON; a short summary goes to stderr
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+package_path = os.path.dirname(bench_path)
+
+# how many files go in each folder of the synthetic projects
+files_per_folder = 20
+folders_per_module = 20
+
+
+def generate(root, layout, num_files):
+    # half of the files are classes, and half are the tests for them
+    #
+    # psr4:   src/ModuleN/PartN/ClassN.php, with composer.json and a
+    #         phpunit.xml at the top
+    # legacy: lib/Vendor/ModuleN/PartN/ClassN.php declaring
+    #         Vendor_ModuleN_PartN_ClassN, with tests/phpunit.xml.dist
+    sources = []
+    tests = []
+    for i in range(0, num_files // 2):
+        module = 'Module' + str(i // (files_per_folder * folders_per_module))
+        part = 'Part' + str((i // files_per_folder) % folders_per_module)
+        name = 'Class' + str(i)
+        if layout == 'psr4':
+            source = os.path.join(root, 'src', module, part, name + '.php')
+            test = os.path.join(root, 'tests', module, part, name + 'Test.php')
+            write(source, '<?php\nnamespace Acme\\%s\\%s;\n\nclass %s\n{\n}\n' % (module, part, name))
+            write(test, '<?php\nnamespace Acme\\Tests\\%s\\%s;\n\nclass %sTest extends TestCase\n{\n    public function testSomething()\n    {\n    }\n}\n' % (module, part, name))
+        else:
+            source = os.path.join(root, 'lib', 'Vendor', module, part, name + '.php')
+            test = os.path.join(root, 'tests', 'Vendor', module, part, name + 'Test.php')
+            write(source, '<?php\n\nclass Vendor_%s_%s_%s\n{\n}\n' % (module, part, name))
+            write(test, '<?php\n\nclass Vendor_%s_%s_%sTest extends PHPUnit_Framework_TestCase\n{\n    public function testSomething()\n    {\n    }\n}\n' % (module, part, name))
+        sources.append(source)
+        tests.append(test)
+
+    if layout == 'psr4':
+        write(os.path.join(root, 'composer.json'), json.dumps({
+            'autoload': {'psr-4': {'Acme\\': 'src/'}},
+            'autoload-dev': {'psr-4': {'Acme\\Tests\\': 'tests/'}},
+        }, indent=4))
+        write(os.path.join(root, 'phpunit.xml'), phpunit_xml('tests'))
+    else:
+        write(os.path.join(root, 'tests', 'phpunit.xml.dist'), phpunit_xml('.'))
+    return sources, tests
+
+
+def phpunit_xml(folder):
+    return '<phpunit>\n    <testsuites>\n        <testsuite name="all">\n            <directory>' + folder + '</directory>\n        </testsuite>\n    </testsuites>\n</phpunit>\n'
+
+
+def write(filename, text):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    f = open(filename, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+
+class Window(object):
+    def __init__(self, folders):
+        self._folders = folders
+
+    def folders(self):
+        return self._folders
+
+    def id(self):
+        return 1
+
+    def active_view(self):
+        return None
+
+    def run_command(self, cmd, args=None):
+        pass
+
+
+class View(object):
+    next_id = [1]
+    class_regex = re.compile(r'^\s*(?:abstract\s+|final\s+)*class\s+(\w+)', re.M)
+
+    def __init__(self, window, filename):
+        import sublime
+        self._window = window
+        self._filename = filename
+        self._settings = sublime.Settings(syntax='Packages/PHP/PHP.tmLanguage')
+        f = open(filename)
+        try:
+            self.text = f.read()
+        finally:
+            f.close()
+        self._id = View.next_id[0]
+        View.next_id[0] += 1
+
+    def file_name(self):
+        return self._filename
+
+    def window(self):
+        return self._window
+
+    def id(self):
+        return self._id
+
+    def change_count(self):
+        return 0
+
+    def settings(self):
+        return self._settings
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def sel(self):
+        import sublime
+        return [sublime.Region(0)]
+
+    def find_all(self, pattern):
+        import sublime
+        return [sublime.Region(m.start(), m.end()) for m in re.finditer(pattern, self.text)]
+
+    def find_by_selector(self, selector):
+        import sublime
+        return [sublime.Region(m.start(1), m.end(1)) for m in self.class_regex.finditer(self.text)]
+
+
+class Timings(object):
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.add(stage, time.time() - start)
+        return result
+
+    def add(self, stage, secs):
+        self.stages.setdefault(stage, []).append(secs * 1000.0)
+
+    def summary(self):
+        result = {}
+        for stage, times in self.stages.items():
+            times = sorted(times)
+            result[stage] = {
+                'count': len(times),
+                'total_ms': round(sum(times), 3),
+                'mean_ms': round(sum(times) / len(times), 3),
+                'p50_ms': round(times[(len(times) - 1) // 2], 3),
+                'p95_ms': round(times[int(0.95 * (len(times) - 1))], 3),
+                'max_ms': round(times[-1], 3),
+            }
+        return result
+
+
+def run_case(root, layout, samples_file):
+    # runs in a fresh process for each project, so that nothing is
+    # cached from one project to the next
+    sys.path.insert(0, os.path.join(bench_path, 'stubs'))
+    sys.path.insert(0, package_path)
+    import sublime
+    sublime.overrides.update({'persist_index': False, 'index_sweep_secs': 0, 'debug': 0})
+    sublime.cache_folder = os.path.join(root, '.bench-cache')
+    import phpunit
+
+    f = open(samples_file)
+    try:
+        samples = json.load(f)
+    finally:
+        f.close()
+
+    timings = Timings()
+    window = Window([root])
+
+    def probe(filename):
+        p = phpunit.ActiveView()
+        p.view = View(window, filename)
+        return p
+
+    # before the ProjectFiles cache exists, we have to search on disk
+    for source in samples['sources']:
+        timings.time('top_folder_cold', probe(source).top_folder)
+    for source in samples['sources']:
+        timings.time('top_folder_warm', probe(source).top_folder)
+    for source in samples['sources']:
+        timings.time('find_test_file_unindexed', probe(source).find_test_file)
+
+    # build the ProjectFiles cache, and then the PHP symbols index
+    top_folder = probe(samples['sources'][0]).top_folder()
+    start = time.time()
+    phpunit.ProjectFiles.buildFilesList(top_folder)
+    while phpunit.ProjectFiles.isBuilding(top_folder):
+        sublime.run_pending()
+    timings.add('build_files_list', time.time() - start)
+    start = time.time()
+    while top_folder in phpunit.PhpSymbols.scans:
+        sublime.run_pending()
+    timings.add('build_symbols_index', time.time() - start)
+
+    # now the lookups that can use the index
+    phpunit.FoundFiles.removeCache()
+    for source in samples['sources']:
+        timings.time('find_test_file_indexed', probe(source).find_test_file)
+    for source in samples['sources']:
+        timings.time('find_test_file_cached', probe(source).find_test_file)
+    for test in samples['tests']:
+        timings.time('find_tested_file_indexed', probe(test).find_tested_file)
+    for source in samples['sources']:
+        timings.time('find_files', phpunit.FindFiles.find, top_folder, os.path.dirname(source), [os.path.basename(source)])
+
+    # the context menu round trip: the first time the menu opens, the
+    # commands start resolving the view in the background; once that
+    # has finished, the menu is opened again
+    commands = context_menu_commands(phpunit)
+    for filename in samples['sources'] + samples['tests']:
+        view = View(window, filename)
+        timings.time('context_menu_first_open', open_menu, commands, view)
+        timings.time('context_menu_resolve', run_all_pending, sublime)
+        timings.time('context_menu_reopen', open_menu, commands, view)
+
+    return timings.summary()
+
+
+def run_all_pending(sublime):
+    while sublime.run_pending() > 0:
+        pass
+
+
+def context_menu_commands(phpunit):
+    f = open(os.path.join(package_path, 'Context.sublime-menu'))
+    try:
+        menu = json.load(f)
+    finally:
+        f.close()
+
+    result = []
+    for item in menu:
+        for child in item.get('children', []):
+            name = ''.join([x.capitalize() for x in child['command'].split('_')]) + 'Command'
+            result.append(getattr(phpunit, name))
+    return result
+
+
+def open_menu(commands, view):
+    for command in commands:
+        cmd = command(view)
+        if cmd.is_visible():
+            cmd.is_enabled()
+            cmd.description()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the resolution pipeline on synthetic PHP projects')
+    parser.add_argument('--sizes', default='1000,50000', help='comma-separated numbers of files (e.g. 1000,50000,500000)')
+    parser.add_argument('--layouts', default='psr4,legacy', help='comma-separated layouts: psr4, legacy')
+    parser.add_argument('--samples', type=int, default=100, help='how many files to resolve in each project')
+    parser.add_argument('--seed', type=int, default=1, help='seed for picking the sample files')
+    parser.add_argument('--output', help='write the JSON results here, instead of to stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the generated projects')
+    parser.add_argument('--run-case', nargs=3, metavar=('ROOT', 'LAYOUT', 'SAMPLES'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        print(json.dumps(run_case(*args.run_case)))
+        return
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': [],
+    }
+    for layout in args.layouts.split(','):
+        for size in [int(x) for x in args.sizes.split(',')]:
+            root = tempfile.mkdtemp(prefix='phpunit-bench-' + layout + '-')
+            try:
+                results['cases'].append(bench(root, layout, size, args))
+            finally:
+                if not args.keep:
+                    shutil.rmtree(root, True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        write(args.output, output + '\n')
+
+
+def bench(root, layout, size, args):
+    print('# ' + layout + ', ' + str(size) + ' files: generating', file=sys.stderr)
+    start = time.time()
+    sources, tests = generate(root, layout, size)
+    generate_secs = time.time() - start
+
+    rand = random.Random(args.seed)
+    samples = {
+        'sources': rand.sample(sources, min(args.samples, len(sources))),
+        'tests': rand.sample(tests, min(args.samples, len(tests))),
+    }
+    samples_file = os.path.join(root, '.bench-samples.json')
+    write(samples_file, json.dumps(samples))
+
+    print('# ' + layout + ', ' + str(size) + ' files: timing', file=sys.stderr)
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-case', root, layout, samples_file])
+    stages = json.loads(output.decode('utf-8'))
+    for stage in sorted(stages.keys()):
+        print('  %-28s mean %10.3fms  p95 %10.3fms  total %12.3fms' % (stage, stages[stage]['mean_ms'], stages[stage]['p95_ms'], stages[stage]['total_ms']), file=sys.stderr)
+
+    return {
+        'layout': layout,
+        'files': size,
+        'generate_secs': round(generate_secs, 3),
+        'stages': stages,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# a stand-in for the parts of Sublime Text's API that the plugin uses,
+# so that the plugin can be loaded and timed outside of the editor
+#
+# nothing runs in the background here: callbacks are queued up, and the
+# benchmark decides when to run them with run_pending()
+
+import json
+import os
+import re
+import tempfile
+
+ENCODED_POSITION = 1
+
+package_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+queue = []
+overrides = {}
+# the benchmark points this inside the project that it generates, so
+# that it is cleaned up along with the project
+cache_folder = None
+
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+
+def version():
+    return '3000'
+
+
+def load_settings(name):
+    f = open(os.path.join(package_path, name))
+    try:
+        # the settings files may have comments in them
+        text = re.sub(r'^\s*//.*$', '', f.read(), flags=re.M)
+    finally:
+        f.close()
+    settings = Settings(json.loads(text))
+    settings.update(overrides)
+    return settings
+
+
+def set_timeout(callback, delay=0):
+    queue.append((delay, callback))
+
+
+def set_timeout_async(callback, delay=0):
+    queue.append((delay, callback))
+
+
+def run_pending():
+    # runs the callbacks that are due now, and returns how many there
+    # were; anything that they queue up waits for the next call, and
+    # delayed callbacks (sweeps, saves and the like) are left alone
+    due = [x for x in queue if x[0] <= 0]
+    queue[:] = [x for x in queue if x[0] > 0]
+    for delay, callback in due:
+        callback()
+    return len(due)
+
+
+def status_message(msg):
+    pass
+
+
+def error_message(msg):
+    pass
+
+
+def cache_path():
+    global cache_folder
+    if cache_folder is None:
+        cache_folder = tempfile.mkdtemp(prefix='phpunit-bench-cache-')
+    return cache_folder
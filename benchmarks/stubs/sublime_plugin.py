@@ -0,0 +1,15 @@
+# a stand-in for Sublime Text's plugin base classes; see sublime.py
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class EventListener(object):
+    pass
@@ -1,12 +1,25 @@
 from __future__ import print_function
 
+import codecs
 import datetime
 import functools
+import hashlib
+import json
+import math
 import os
 import re
+import shutil
+import subprocess
 import sublime
 import sublime_plugin
 import sys
+import tempfile
+import threading
+import time
+import zlib
+import xml.parsers.expat
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 
 
 class Prefs:
@@ -16,6 +29,12 @@ class Prefs:
         Prefs.folder_search_hints = settings.get('top_folder_hints', [])
         Prefs.folder_exclusions = settings.get('folder_exclusions', [])
         Prefs.max_search_secs = settings.get('max_search_secs', 2)
+        Prefs.index_sweep_secs = settings.get('index_sweep_secs', 30)
+        Prefs.persist_index = settings.get('persist_index', True)
+        Prefs.negative_cache_secs = settings.get('negative_cache_secs', 30)
+        Prefs.cache_max_entries = settings.get('cache_max_entries', 1000)
+        Prefs.cache_validate_secs = settings.get('cache_validate_secs', 10)
+        Prefs.symbol_scan_bytes = settings.get('symbol_scan_bytes', 8192)
         Prefs.phpunit_xml_aliases = settings.get('phpunit_xml_aliases', ["phpunit.xml", "phpunit.xml.dist"])
         Prefs.phpunit_xml_location_hints = settings.get('phpunit_xml_location_hints', [])
         Prefs.phpunit_additional_args = settings.get('phpunit_additional_args', {})
@@ -24,7 +43,11 @@ class Prefs:
         Prefs.copy_env = settings.get('copy_env', True)
         Prefs.override_env = settings.get('override_env', {})
         Prefs.run_on_save = settings.get('run_on_save', False)
+        Prefs.run_on_save_delay_secs = settings.get('run_on_save_delay_secs', 0.5)
         Prefs.context_menu = settings.get('context_menu', True)
+        Prefs.parallel_workers = settings.get('parallel_workers', 0)
+        Prefs.output_max_chars = settings.get('output_max_chars', 1000000)
+        Prefs.coverage_impact = settings.get('coverage_impact', False)
 
         # which version of ST are we working inside?
         if sys.version_info[0] == 2:
@@ -40,10 +63,53 @@ Prefs.load()
 class Msgs:
     operation = 'top-level'
 
+    # operation -> [calls, total secs, slowest secs]
+    timings = {}
+
+    @staticmethod
+    def debug_msg(msg, *args):
+        # any args are only formatted into the message when debugging is
+        # switched on, so pass them in rather than building the string
+        if Prefs.debug != 1:
+            return
+        if args:
+            msg = msg % args
+        print("[PHPUnit Plugin " + Msgs.operation + "()] " + msg)
+
     @staticmethod
-    def debug_msg(msg):
-        if Prefs.debug == 1:
-            print("[PHPUnit Plugin " + Msgs.operation + "()] " + msg)
+    def span(operation):
+        # decorator: names the operation that the method performs, so
+        # that debug messages say where they came from, and when
+        # debugging is switched on, times how long each call takes
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                outer = Msgs.operation
+                Msgs.operation = operation
+                if Prefs.debug != 1:
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        Msgs.operation = outer
+
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    Msgs.endSpan(operation, time.time() - start)
+                    Msgs.operation = outer
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def endSpan(operation, secs):
+        timing = Msgs.timings.get(operation)
+        if timing is None:
+            timing = Msgs.timings[operation] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += secs
+        timing[2] = max(timing[2], secs)
+        Msgs.debug_msg('-- took %.3fms (%d call(s), mean %.3fms, slowest %.3fms)', secs * 1000, timing[0], timing[1] * 1000 / timing[0], timing[2] * 1000)
 
 Msgs.debug_msg('')
 Msgs.debug_msg('')
@@ -56,22 +122,57 @@ Msgs.debug_msg('')
 Msgs.debug_msg('')
 
 
+class Background:
+    # how long each slice of a long job may run for; on ST3, every plugin
+    # shares one async thread, so we must not hold on to it for long
+    slice_secs = 0.05
+
+    @staticmethod
+    def deadline():
+        return datetime.datetime.now() + datetime.timedelta(seconds=Background.slice_secs)
+
+    @staticmethod
+    def run(callback, delay=0):
+        # ST2 has no async thread of its own for plugins to use
+        if Prefs.st2:
+            threading.Timer(delay / 1000.0, callback).start()
+        else:
+            sublime.set_timeout_async(callback, delay)
+
+    @staticmethod
+    def status_message(msg):
+        sublime.set_timeout(functools.partial(sublime.status_message, msg), 0)
+
+
 class EraseViewCommand(sublime_plugin.TextCommand):
     def run(self, edit, size=0):
         self.view.erase(edit, sublime.Region(0, size))
 
 
 class InsertViewCommand(sublime_plugin.TextCommand):
-    def run(self, edit, string=''):
-        self.view.insert(edit, self.view.size(), string)
+    def run(self, edit, string='', point=None):
+        if point is None:
+            point = self.view.size()
+        self.view.insert(edit, point, string)
 
 
 class OutputView(object):
+    newlines_regex = re.compile('\r\n?')
+    erase_line_regex = re.compile(r'(.*)(\[2K|;\d+m)')
+    colours_regex = re.compile(r'\[(\d+)m')
+    # how often we update the panel while output is arriving
+    flush_msecs = 50
+
     def __init__(self, name, window, edit=None):
         self.output_name = name
         self.window = window
         self.edit = edit
         self.is_running = False
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flush_scheduled = False
+        self.discarded = False
+        self.log_filename = None
 
     def show_output(self):
         self.ensure_output_view()
@@ -95,23 +196,111 @@ class OutputView(object):
             panel_settings.set('spell_check', False)
             panel_settings.set('word_wrap', True)
             panel_settings.set('color_scheme', 'Packages/PHPUnit/color-schemes/phix-dark.hidden-tmTheme')
+            # lets the user double-click on errors to go to the file
+            panel_settings.set('result_file_regex', '([a-zA-Z0-9\\.\\/_-]+)(?: on line |\\:)([0-9]+)$')
+
+    def set_result_base_dir(self, folder):
+        self.ensure_output_view()
+        self.output_view.settings().set('result_base_dir', folder)
 
     def clear_output_view(self):
         self.ensure_output_view()
+        self.lock.acquire()
+        try:
+            self.pending = []
+        finally:
+            self.lock.release()
+        self.log_filename = None
+
         self.output_view.set_read_only(False)
-        self.output_view.run_command('erase_view')
+        self.output_view.run_command('erase_view', {'size': self.output_view.size()})
         self.output_view.set_read_only(True)
 
+    def discard(self):
+        # drops any output that has not reached the panel yet, and any
+        # more that arrives after this
+        self.lock.acquire()
+        try:
+            self.discarded = True
+            self.pending = []
+        finally:
+            self.lock.release()
+
     def append_data(self, data):
-        data = data.replace('\r\n', '\n').replace('\r', '\n')
-        data = re.sub('(.*)(\[2K|;\d+m)', '', data)
-        data = re.sub('\[(\d+)m', '', data)
+        # PHPUnit can send us thousands of tiny pieces of output; we
+        # collect them up, and add them to the panel in one go
+        self.lock.acquire()
+        try:
+            if self.discarded:
+                return
+            self.pending.append(data)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        finally:
+            self.lock.release()
+        sublime.set_timeout(self.flush, self.flush_msecs)
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            data = ''.join(self.pending)
+            self.pending = []
+            self.flush_scheduled = False
+        finally:
+            self.lock.release()
+        if len(data) == 0:
+            return
 
+        data = self.newlines_regex.sub('\n', data)
+        data = self.erase_line_regex.sub('', data)
+        data = self.colours_regex.sub('', data)
+
+        self.ensure_output_view()
         self.output_view.set_read_only(False)
+        if self.log_filename is not None:
+            self.write_log(data)
         self.output_view.run_command('insert_view', {'string': data})
+        self.trim_output()
         self.output_view.show(self.output_view.size())
         self.output_view.set_read_only(True)
 
+    def trim_output(self):
+        # very large panels slow the whole editor down, so we only keep
+        # the most recent output in the panel; the full output goes into
+        # a log file on disk instead
+        size = self.output_view.size()
+        if Prefs.output_max_chars <= 0 or size <= Prefs.output_max_chars:
+            return
+
+        if self.log_filename is None:
+            self.log_filename = os.path.join(tempfile.gettempdir(), 'sublime-phpunit-' + str(self.window.id()) + '.log')
+            f = open(self.log_filename, 'wb')
+            f.close()
+            self.write_log(self.output_view.substr(sublime.Region(0, size)))
+
+        # we trim back to well under the limit, so that we are not doing
+        # this on every update, and we always cut at the end of a line
+        cut = size - (Prefs.output_max_chars * 9 // 10)
+        newline = self.output_view.substr(sublime.Region(cut, min(size, cut + 1000))).find('\n')
+        if newline >= 0:
+            cut = cut + newline + 1
+        self.output_view.run_command('erase_view', {'size': cut})
+        self.output_view.run_command('insert_view', {
+            'string': '[... earlier output removed; the full output is in ' + self.log_filename + ' ...]\n',
+            'point': 0,
+        })
+
+    def write_log(self, data):
+        try:
+            f = open(self.log_filename, 'ab')
+            try:
+                f.write(data.encode('utf-8'))
+            finally:
+                f.close()
+        except (IOError, OSError):
+            Msgs.debug_msg('-- unable to write to %s', self.log_filename)
+
 
 class CompatibilityOutputView:
     def __init__(self, name, window, edit=None):
@@ -141,11 +330,114 @@ class CompatibilityOutputView:
         else:
             self.wrapped_view.append_data(data)
 
+    def discard(self):
+        # this has to happen straight away, so that any output that is
+        # already on its way to the panel is dropped too
+        self.wrapped_view.discard()
+
+    def set_result_base_dir(self, folder):
+        if Prefs.st2:
+            sublime.set_timeout(functools.partial(self.wrapped_view.set_result_base_dir, folder), 0)
+        else:
+            self.wrapped_view.set_result_base_dir(folder)
+
+
+class AsyncProcess(object):
+    # runs a command without a shell, and feeds its output back to a
+    # listener as it arrives
+    #
+    # the listener needs on_data(proc, data) and on_finished(proc)
+    # methods; both are called from a background thread
+
+    def __init__(self, args, cwd, env, listener):
+        self.listener = listener
+        self.killed = False
+        self.exit_code = None
+        self.start = datetime.datetime.now()
+        self.duration = None
+
+        try:
+            # Windows needs a shell to run .bat files, such as phpunit.bat
+            cmd = args
+            if os.name == 'nt':
+                cmd = AsyncProcess.command_line(args)
+            self.proc = subprocess.Popen(cmd, cwd=cwd, env=env,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         shell=(os.name == 'nt'))
+        except OSError as e:
+            self.proc = None
+            self.listener.on_data(self, "Unable to run " + args[0] + ": " + str(e) + "\n")
+            self.finished(255)
+            return
+
+        self.proc.stdin.close()
+        thread = threading.Thread(target=self.read_output)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def command_line(args):
+        # cmd.exe treats characters such as | and & as special, even in
+        # the middle of an argument, unless they are inside quotes
+        result = []
+        for arg in args:
+            arg = subprocess.list2cmdline([arg])
+            if re.search(r'[&|<>^]', arg) and not arg.startswith('"'):
+                arg = '"' + arg + '\\' * (len(arg) - len(arg.rstrip('\\'))) + '"'
+            result.append(arg)
+        return ' '.join(result)
+
+    def read_output(self):
+        # output can arrive part-way through a multi-byte character
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        fileno = self.proc.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fileno, 32768)
+            except OSError:
+                data = b''
+            if len(data) == 0:
+                break
+            self.listener.on_data(self, decoder.decode(data))
+
+        # anything left is an incomplete character at the very end
+        data = decoder.decode(b'', True)
+        if len(data) > 0:
+            self.listener.on_data(self, data)
+
+        self.proc.stdout.close()
+        self.finished(self.proc.wait())
+
+    def finished(self, exit_code):
+        self.exit_code = exit_code
+        self.duration = datetime.datetime.now() - self.start
+        self.listener.on_finished(self)
+
+    def kill(self):
+        if self.proc is None or self.exit_code is not None:
+            return
+        self.killed = True
+        try:
+            self.proc.terminate()
+        except OSError:
+            pass
+
+    def duration_secs(self):
+        return self.duration.seconds + (self.duration.microseconds / 1000000.0)
+
 
 class CommandBase:
-    def __init__(self, window, edit):
+    # the command that is currently running in each window
+    running = {}
+    # set once another run has taken over our output panel
+    replaced = False
+
+    def __init__(self, window, edit=None):
         self.window = window
         self.edit = edit
+        self.procs = []
 
     def show_output(self):
         if not hasattr(self, 'output_view'):
@@ -160,27 +452,96 @@ class CommandBase:
         self.output_view.clear_output_view()
         self.output_view.show_output()
 
+    def claim_window(self):
+        # only one run per window; a new run replaces the old one
+        cmd = CommandBase.running.pop(self.window.id(), None)
+        if cmd is not None:
+            cmd.replace()
+        CommandBase.running[self.window.id()] = self
+
+    def release_window(self):
+        if CommandBase.running.get(self.window.id()) is self:
+            del CommandBase.running[self.window.id()]
+
+    @staticmethod
+    def cancel(window):
+        cmd = CommandBase.running.pop(window.id(), None)
+        if cmd is not None:
+            cmd.kill()
+
+    @staticmethod
+    def is_running_in(window):
+        return window.id() in CommandBase.running
+
+    @staticmethod
+    def cancel_project(folder):
+        # a new run of this project is about to start
+        for window_id, cmd in list(CommandBase.running.items()):
+            if getattr(cmd, 'folder', None) == folder:
+                CommandBase.running.pop(window_id, None)
+                cmd.replace()
+
+    def kill(self):
+        for proc in self.procs:
+            proc.kill()
+
+    def replace(self):
+        # the new run owns the output panel and the status bar now, so
+        # anything more that we have to say is thrown away
+        self.replaced = True
+        if hasattr(self, 'output_view'):
+            self.output_view.discard()
+        self.kill()
+
+    def build_env(self):
+        if Prefs.copy_env:
+            env = os.environ.copy()
+        else:
+            env = {}
+        for key, value in Prefs.override_env.items():
+            env[key] = value
+        return env
+
+    def start_process(self, executable, cwd, listener):
+        proc = AsyncProcess(executable, cwd, self.build_env(), listener)
+        self.procs.append(proc)
+        return proc
+
     def start_async(self, caption, executable, cwd):
+        self.claim_window()
         self.is_running = True
-        self.proc = AsyncProcess(executable, cwd, self)
+        self.update_status(caption, "...")
+        self.proc = self.start_process(executable, cwd, self)
         # StatusProcess(caption, self)
 
+    def on_data(self, proc, data):
+        self.append_data(data)
+
+    def on_finished(self, proc):
+        self.is_running = False
+        self.release_window()
+        if proc.killed:
+            self.append_data("\n[Cancelled]\n")
+            self.update_status("PHPUnit:", "cancelled")
+            return
+
+        msg = "finished in %.2fs with exit code %d" % (proc.duration_secs(), proc.exit_code)
+        self.append_data("\n[" + msg[0].upper() + msg[1:] + "]\n")
+        self.update_status("PHPUnit:", msg)
+
     def append_data(self, data):
+        if self.replaced:
+            return
         self.output_view.append_data(data)
 
     def update_status(self, msg, progress):
-        sublime.status_message(msg + " " + progress)
+        if self.replaced:
+            return
+        Background.status_message(msg + " " + progress)
 
 
 class PhpunitCommand(CommandBase):
-    def run(self, folder, configfile, testfile='', classname=''):
-        self.show_empty_output()
-
-        # if os.path.isdir(configfile):
-        #     folder = configfile
-        # else:
-        #     folder = os.path.dirname(configfile)
-
+    def phpunit_args(self, folder):
         if Prefs.path_to_phpunit is not False:
             args = [Prefs.path_to_phpunit]
         elif os.path.isfile(folder + "/vendor/bin/phpunit"):
@@ -196,22 +557,59 @@ class PhpunitCommand(CommandBase):
                 arg += "=" + value
             args.append(arg)
 
-        # remove the folder from the configfile
-        if configfile.startswith(folder):
-            configfile = configfile[len(folder):]
-            if configfile[0] == "/":
-                configfile = configfile[1:]
+        return args
+
+    def junit_log_filename(self):
+        # PHPUnit writes the results of the run here, for us to read back
+        # once it has finished
+        fd, filename = tempfile.mkstemp(prefix='phpunit-', suffix='.xml')
+        os.close(fd)
+        return filename
+
+    def relative_path(self, folder, path):
+        # remove the folder from the path
+        if path.startswith(folder):
+            path = path[len(folder):]
+            if path[0] == "/":
+                path = path[1:]
+        return path
+
+    def run(self, folder, configfile, testfile='', classname='', test_filter='', coverage=False):
+        self.show_empty_output()
+
+        # if os.path.isdir(configfile):
+        #     folder = configfile
+        # else:
+        #     folder = os.path.dirname(configfile)
 
-        # remove the folder from the testfile
-        if testfile.startswith(folder):
-            testfile = testfile[len(folder):]
-            if testfile[0] == "/":
-                testfile = testfile[1:]
+        args = self.phpunit_args(folder)
+
+        self.folder = folder
+        self.configfile = configfile
+
+        # remove the folder from the configfile and the testfile
+        configfile = self.relative_path(folder, configfile)
+        testfile = self.relative_path(folder, testfile)
 
         if os.path.isfile(os.path.join(folder, configfile)):
             args.append("-c")
             args.append(configfile)
 
+        self.junit_log = self.junit_log_filename()
+        args.append("--log-junit")
+        args.append(self.junit_log)
+
+        if test_filter != '':
+            args.append("--filter")
+            args.append(test_filter)
+
+        # the coverage report tells us which tests run which code
+        self.coverage_folder = None
+        if coverage:
+            self.coverage_folder = tempfile.mkdtemp(prefix='phpunit-coverage-')
+            args.append("--coverage-xml")
+            args.append(self.coverage_folder)
+
         # determine the unit test to run
         if classname == '' and testfile != '':
             classname = os.path.basename(testfile)
@@ -225,44 +623,780 @@ class PhpunitCommand(CommandBase):
         self.append_data("# Running in folder: " + folder + "\n")
         self.append_data("# Configfile is: " + configfile + "\n")
         self.append_data("$ " + ' '.join(args) + "\n")
-        self.window.run_command('exec', {
-            'cmd': ' '.join(args),
-            'working_dir': folder,
-            'file_regex': '([a-zA-Z0-9\\.\\/_-]+)(?: on line |\:)([0-9]+)$',
-            'shell': True,
-            'quiet': False,
-        })
+        self.output_view.set_result_base_dir(folder)
+        self.start_async("PHPUnit: running tests", args, folder)
+
+    def on_finished(self, proc):
+        results = self.read_junit_log(self.junit_log, proc)
+        if results is not None:
+            TestResults.store(self.window, self.folder, self.configfile, results)
+            TestDurations.record(self.folder, results)
+            self.append_data("\n# " + TestResults.summary(results) + "\n")
+        if self.coverage_folder is not None:
+            if results is not None:
+                CoverageMap.update(self.folder, self.coverage_folder, set([x.full_name() for x in results]))
+            shutil.rmtree(self.coverage_folder, True)
+        CommandBase.on_finished(self, proc)
+
+    def read_junit_log(self, filename, proc):
+        results = None
+        if not proc.killed:
+            results = JUnitLog.parse(filename)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return results
+
+
+class PhpunitXml:
+    @staticmethod
+    def findTestFiles(configfile):
+        # which test files make up the testsuites in this config file?
+        try:
+            root = ElementTree.parse(configfile).getroot()
+        except (IOError, OSError, SyntaxError, xml.parsers.expat.ExpatError):
+            Msgs.debug_msg('-- unable to parse %s', configfile)
+            return []
+
+        folder = os.path.dirname(configfile)
+        result = set()
+        excluded = set()
+        for testsuite in root.findall('.//testsuite'):
+            for node in testsuite.findall('exclude'):
+                if node.text is not None:
+                    excluded.add(os.path.normpath(os.path.join(folder, node.text.strip())))
+            for node in testsuite.findall('file'):
+                if node.text is not None:
+                    result.add(os.path.normpath(os.path.join(folder, node.text.strip())))
+            for node in testsuite.findall('directory'):
+                if node.text is None:
+                    continue
+                path = os.path.normpath(os.path.join(folder, node.text.strip()))
+                suffix = node.get('suffix', 'Test.php')
+                prefix = node.get('prefix', '')
+                for filename in PhpunitXml.filesUnder(path):
+                    name = os.path.basename(filename)
+                    if name.endswith(suffix) and name.startswith(prefix):
+                        result.add(filename)
+
+        return sorted([x for x in result if not PhpunitXml.isExcluded(x, excluded)])
+
+    @staticmethod
+    def filesUnder(path):
+        # the ProjectFiles cache saves us from walking the tree again
+        top_folder = ProjectFiles.topFolderFor(path)
+        if top_folder is not None and not ProjectFiles.isBuilding(top_folder):
+            prefix = os.path.join(path, '')
+            return [x for x in list(ProjectFiles.files[top_folder]) if x.startswith(prefix)]
+
+        result = []
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                result.append(os.path.join(root, name))
+        return result
+
+    @staticmethod
+    def isExcluded(filename, excluded):
+        for path in excluded:
+            if filename == path or filename.startswith(os.path.join(path, '')):
+                return True
+        return False
+
+
+class ParallelPhpunitCommand(PhpunitCommand):
+    testsuites_regex = re.compile(r'<testsuites\b.*?</testsuites>', re.S)
+    colours_regex = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+    ok_regex = re.compile(r'^OK \((\d+) tests?, (\d+) assertions?\)', re.M)
+    totals_regex = re.compile(r'^Tests: (\d+), Assertions: (\d+)(.*)$', re.M)
+    count_regex = re.compile(r'([A-Za-z]+): (\d+)')
+
+    def run(self, folder, configfile):
+        self.show_empty_output()
+
+        self.folder = folder
+        self.configfile = configfile
+        test_files = PhpunitXml.findTestFiles(configfile)
+        if len(test_files) == 0:
+            self.append_data("# No test files found in the testsuites in " + configfile + "\n")
+            return
+
+        f = open(configfile, 'rb')
+        try:
+            config = f.read().decode('utf-8')
+        finally:
+            f.close()
+        if self.testsuites_regex.search(config) is None:
+            self.append_data("# No <testsuites> found in " + configfile + "\n")
+            return
+
+        shards = self.shard(test_files, self.num_workers())
+        self.append_data("# Running in folder: " + folder + "\n")
+        self.append_data("# Configfile is: " + self.relative_path(folder, configfile) + "\n")
+        self.append_data("# Running " + str(len(test_files)) + " test file(s) in " + str(len(shards)) + " parallel shard(s)\n")
+
+        self.output_view.set_result_base_dir(folder)
+        self.claim_window()
+        self.start = datetime.datetime.now()
+        self.lock = threading.Lock()
+        self.results = []
+        self.test_results = []
+        self.num_shards = len(shards)
+        for i in range(0, len(shards)):
+            # each shard gets its own copy of the config file, listing
+            # only its own tests; it has to live alongside the original,
+            # so that any relative paths inside it still work, and it
+            # needs a name of its own, as other runs may be using the
+            # same folder
+            fd, shard_config = tempfile.mkstemp(dir=os.path.dirname(configfile), prefix='.phpunit-shard-', suffix='.xml')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(self.testsuites_regex.sub(lambda x: self.shard_testsuites(i, shards[i]), config, 1).encode('utf-8'))
+            finally:
+                f.close()
+
+            junit_log = self.junit_log_filename()
+            args = self.phpunit_args(folder) + ['-c', shard_config, '--log-junit', junit_log]
+            self.start_process(args, folder, ShardOutput(self, i, len(shards[i]), shard_config, junit_log))
+
+    def num_workers(self):
+        if Prefs.parallel_workers > 0:
+            return Prefs.parallel_workers
+        try:
+            import multiprocessing
+            return multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            return 2
+
+    def shard(self, test_files, num_shards):
+        shards = []
+        for i in range(0, min(num_shards, len(test_files))):
+            shards.append([])
+
+        # if we know how long the tests take, we give the next slowest
+        # file to whichever shard has the least work so far
+        times = TestDurations.fileTimes(self.folder, test_files)
+        if times is not None:
+            totals = [0] * len(shards)
+            for filename in sorted(test_files, key=lambda x: -times[x]):
+                i = totals.index(min(totals))
+                shards[i].append(filename)
+                totals[i] += times[filename]
+            return shards
+
+        for i in range(0, len(test_files)):
+            shards[i % len(shards)].append(test_files[i])
+        return shards
+
+    def shard_testsuites(self, i, test_files):
+        result = '<testsuites>\n        <testsuite name="shard-' + str(i + 1) + '">\n'
+        for filename in test_files:
+            result += '            <file>' + escape(filename) + '</file>\n'
+        return result + '        </testsuite>\n    </testsuites>'
+
+    def shard_finished(self, shard, proc, output):
+        try:
+            os.remove(shard.shard_config)
+        except OSError:
+            pass
+        test_results = self.read_junit_log(shard.junit_log, proc)
+
+        # we show each shard's output in one piece, so that the output
+        # from different shards does not get mixed together
+        self.lock.acquire()
+        try:
+            self.append_data("\n# Shard " + str(shard.i + 1) + "/" + str(self.num_shards) + " (" + str(shard.num_files) + " test file(s)), exit code " + str(proc.exit_code) + "\n")
+            self.append_data(output)
+            self.results.append((proc, self.colours_regex.sub('', output)))
+            if test_results is not None:
+                self.test_results.extend(test_results)
+            if len(self.results) == self.num_shards:
+                self.release_window()
+                self.show_summary()
+        finally:
+            self.lock.release()
+
+    def show_summary(self):
+        totals = {}
+        exit_code = 0
+        cancelled = False
+        for proc, output in self.results:
+            exit_code = max(exit_code, proc.exit_code)
+            cancelled = cancelled or proc.killed
+            for match in self.ok_regex.finditer(output):
+                totals['Tests'] = totals.get('Tests', 0) + int(match.group(1))
+                totals['Assertions'] = totals.get('Assertions', 0) + int(match.group(2))
+            for match in self.totals_regex.finditer(output):
+                totals['Tests'] = totals.get('Tests', 0) + int(match.group(1))
+                totals['Assertions'] = totals.get('Assertions', 0) + int(match.group(2))
+                for name, count in self.count_regex.findall(match.group(3)):
+                    totals[name] = totals.get(name, 0) + int(count)
+
+        summary = []
+        for name in ['Tests', 'Assertions', 'Errors', 'Failures', 'Warnings', 'Skipped', 'Incomplete', 'Risky']:
+            if name in totals:
+                summary.append(name + ": " + str(totals[name]))
+
+        # the JUnit logs are more reliable than the text output, when
+        # we have them
+        if len(self.test_results) > 0:
+            summary = [TestResults.summary(self.test_results)]
+
+        duration = datetime.datetime.now() - self.start
+        self.append_data("\n# All " + str(self.num_shards) + " shard(s) finished in " + str(duration.seconds) + "." + str(duration.microseconds // 10000).zfill(2) + "s\n")
+        self.append_data("# " + ", ".join(summary) + "\n")
+        self.append_data("# Exit code: " + str(exit_code) + "\n")
+        if cancelled:
+            self.append_data("\n[Cancelled]\n")
+        else:
+            TestResults.store(self.window, self.folder, self.configfile, self.test_results)
+            TestDurations.record(self.folder, self.test_results)
+        self.update_status("PHPUnit:", "all shards finished with exit code " + str(exit_code))
+
+
+class ShardOutput(object):
+    # collects the output of one shard of a parallel run
+    def __init__(self, cmd, i, num_files, shard_config, junit_log):
+        self.cmd = cmd
+        self.i = i
+        self.num_files = num_files
+        self.shard_config = shard_config
+        self.junit_log = junit_log
+        self.output = []
+
+    def on_data(self, proc, data):
+        self.output.append(data)
+
+    def on_finished(self, proc):
+        self.cmd.shard_finished(self, proc, ''.join(self.output))
+
+
+class RunScheduler:
+    # saves tend to arrive in bursts (think "Save All"), so we wait for
+    # them to stop, and then run the tests for all of them at once
+    #
+    # top_folder -> the run that is waiting to start
+    pending = {}
+
+    @staticmethod
+    def schedule(window, top_folder, configfile, test_file, test_names):
+        # a newer save replaces any run that is still going
+        CommandBase.cancel_project(top_folder)
+
+        request = {'window': window, 'config': configfile, 'files': [], 'tests': []}
+        waiting = RunScheduler.pending.get(top_folder)
+        if waiting is not None and waiting['config'] == configfile:
+            request['files'] = list(waiting['files'])
+            request['tests'] = list(waiting['tests'])
+        if test_file is not None and test_file not in request['files']:
+            request['files'].append(test_file)
+        for name in test_names:
+            if name not in request['tests']:
+                request['tests'].append(name)
+
+        RunScheduler.pending[top_folder] = request
+        Background.run(functools.partial(RunScheduler.run, top_folder, request), int(Prefs.run_on_save_delay_secs * 1000))
+
+    @staticmethod
+    def run(top_folder, request):
+        # has a later save replaced us?
+        if RunScheduler.pending.get(top_folder) is not request:
+            return
+        del RunScheduler.pending[top_folder]
+
+        cmd = PhpunitCommand(request['window'], None)
+        if len(request['files']) == 1 and len(request['tests']) == 0:
+            cmd.run(top_folder, request['config'], request['files'][0], coverage=Prefs.coverage_impact)
+            return
+
+        # PHPUnit only accepts one test file on the command line, so we
+        # pick out several by their class names instead
+        classes = [os.path.splitext(os.path.basename(x))[0] for x in request['files']]
+        cmd.run(top_folder, request['config'], test_filter=TestResults.filterFor(request['tests'], classes), coverage=Prefs.coverage_impact)
+
+
+class CoverageMap:
+    # which tests run the code in each source file?
+    #
+    # we build this from PHPUnit's XML code coverage report, which
+    # lists the tests that covered each line
+    #
+    # top_folder -> { source file -> set(test names) }
+    tests = {}
+
+    @staticmethod
+    def testsFor(top_folder, filename):
+        ProjectCache.loadCoverage(top_folder)
+        return sorted(CoverageMap.tests.get(top_folder, {}).get(filename, []))
+
+    @staticmethod
+    def restore(top_folder, coverage):
+        files = {}
+        for filename, names in coverage.items():
+            files[filename] = set(names)
+        CoverageMap.tests[top_folder] = files
+
+    @staticmethod
+    def update(top_folder, report_folder, tests_run):
+        covered = CoverageMap.readReport(report_folder)
+        if covered is None:
+            return
+
+        # the tests we have just run may no longer cover the same code
+        # as they did before
+        files = CoverageMap.tests.setdefault(top_folder, {})
+        for filename in list(files.keys()):
+            files[filename].difference_update(tests_run)
+            if len(files[filename]) == 0:
+                del files[filename]
+        for filename, names in covered.items():
+            files.setdefault(filename, set()).update(names)
+
+        Msgs.debug_msg('Coverage map for %s now covers %s file(s)', top_folder, len(files))
+        ProjectCache.scheduleSave(top_folder)
+
+    @staticmethod
+    def readReport(report_folder):
+        # the report has an index.xml, and one XML file per source file
+        index = os.path.join(report_folder, 'index.xml')
+        project = {}
+        if not CoverageMap.parseFile(index, functools.partial(CoverageMap.readProject, project)):
+            return None
+        if 'source' not in project:
+            return None
+
+        covered = {}
+        for root, dirs, files in os.walk(report_folder):
+            for name in files:
+                filename = os.path.join(root, name)
+                if name.endswith('.xml') and filename != index:
+                    CoverageMap.parseFile(filename, functools.partial(CoverageMap.addCovered, project['source'], covered, {}))
+        return covered
+
+    @staticmethod
+    def readProject(project, name, attrs):
+        if name == 'project':
+            project.update(attrs)
+
+    @staticmethod
+    def addCovered(source, covered, current, name, attrs):
+        if name == 'file':
+            # the path is relative to the top of the source folder
+            current['file'] = os.path.normpath(os.path.join(source, attrs.get('path', '').lstrip('/'), attrs.get('name', '')))
+        elif name == 'covered' and 'file' in current:
+            covered.setdefault(current['file'], set()).add(attrs.get('by'))
+
+    @staticmethod
+    def parseFile(filename, start_element):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = start_element
+        try:
+            f = open(filename, 'rb')
+            try:
+                parser.ParseFile(f)
+            finally:
+                f.close()
+        except (IOError, OSError, xml.parsers.expat.ExpatError):
+            Msgs.debug_msg('-- unable to parse %s', filename)
+            return False
+        return True
+
+
+class TestDurations:
+    # how long each test has taken on its recent runs, so that we can
+    # spot slow tests, and balance the work in parallel runs
+    #
+    # top_folder -> { test name -> [recent times, oldest first] }
+    history = {}
+    # top_folder -> how many runs have been added to the file on disk
+    runs = {}
+    # how many times we remember for each test
+    max_samples = 20
+    # we rewrite the file on disk once it has this many runs in it
+    max_runs = 100
+
+    @staticmethod
+    def record(top_folder, results):
+        ProjectCache.loadDurations(top_folder)
+        history = TestDurations.history.setdefault(top_folder, {})
+
+        times = {}
+        for result in results:
+            if result.status == 'skipped':
+                continue
+            times[result.full_name()] = round(result.time, 4)
+            TestDurations.addSamples(history, result.full_name(), [result.time])
+        if len(times) == 0 or ProjectCache.filename(top_folder, '.durations') is None:
+            return
+
+        TestDurations.runs[top_folder] = TestDurations.runs.get(top_folder, 0) + 1
+        if TestDurations.runs[top_folder] > TestDurations.max_runs:
+            TestDurations.compact(top_folder)
+        else:
+            ProjectCache.append(top_folder, '.durations', (json.dumps(times, separators=(',', ':')) + '\n').encode('utf-8'))
+
+    @staticmethod
+    def restore(top_folder, line):
+        # each line is either one run's times, or the list of times that
+        # we kept when we last compacted the file
+        history = TestDurations.history.setdefault(top_folder, {})
+        for name, times in line.items():
+            if not isinstance(times, list):
+                times = [times]
+            TestDurations.addSamples(history, name, times)
+        TestDurations.runs[top_folder] = TestDurations.runs.get(top_folder, 0) + 1
+
+    @staticmethod
+    def addSamples(history, name, times):
+        samples = history.setdefault(name, [])
+        samples.extend(times)
+        if len(samples) > TestDurations.max_samples:
+            del samples[:len(samples) - TestDurations.max_samples]
+
+    @staticmethod
+    def compact(top_folder):
+        history = {}
+        for name, samples in list(TestDurations.history[top_folder].items()):
+            history[name] = [round(x, 4) for x in samples]
+        ProjectCache.write(top_folder, '.durations', (json.dumps(history, separators=(',', ':')) + '\n').encode('utf-8'))
+        TestDurations.runs[top_folder] = 1
+
+    @staticmethod
+    def get(top_folder):
+        ProjectCache.loadDurations(top_folder)
+        return TestDurations.history.get(top_folder, {})
+
+    @staticmethod
+    def percentile(samples, percent):
+        samples = sorted(samples)
+        i = int(math.ceil(percent / 100.0 * len(samples))) - 1
+        return samples[max(0, min(i, len(samples) - 1))]
+
+    @staticmethod
+    def slowest(top_folder):
+        # [name, p50, p95, number of runs], slowest first
+        result = []
+        for name, samples in list(TestDurations.get(top_folder).items()):
+            result.append([name, TestDurations.percentile(samples, 50), TestDurations.percentile(samples, 95), len(samples)])
+        result.sort(key=lambda x: (-x[2], -x[1], x[0]))
+        return result
+
+    @staticmethod
+    def fileTimes(top_folder, filenames):
+        # how long do we expect each of these test files to take?
+        classes = {}
+        for name, samples in list(TestDurations.get(top_folder).items()):
+            classname = name.split('::')[0]
+            classes[classname] = classes.get(classname, 0) + TestDurations.percentile(samples, 50)
+        if len(classes) == 0:
+            return None
+
+        result = {}
+        for filename in filenames:
+            # the index tells us which classes are in the file; if it is
+            # not ready, we assume that the class is named after the file
+            declared = PhpSymbols.declared.get(top_folder, {}).get(filename)
+            if declared is not None:
+                times = [classes[x] for x in declared if x in classes]
+            else:
+                basename = os.path.splitext(os.path.basename(filename))[0]
+                times = [classes[x] for x in classes if x.split('\\')[-1] == basename]
+            if len(times) > 0:
+                result[filename] = sum(times)
+
+        # files that we know nothing about get an average time
+        if len(result) == 0:
+            return None
+        average = sum(result.values()) / len(result)
+        for filename in filenames:
+            result.setdefault(filename, average)
+        return result
+
+
+class TestResult(object):
+    # the outcome of a single test
+    def __init__(self, classname, name, filename, line):
+        self.classname = classname
+        self.name = name
+        self.filename = filename
+        self.line = line
+        self.status = 'passed'
+        self.time = 0.0
+        self.assertions = 0
+        self.message = ''
+        # where the test went wrong
+        self.failed_file = filename
+        self.failed_line = line
+
+    def is_failed(self):
+        return self.status in ('failure', 'error')
+
+    def full_name(self):
+        return self.classname + '::' + self.name
+
+
+class JUnitLog(object):
+    # reads the JUnit XML log that PHPUnit writes a chunk at a time, so
+    # that we never have to hold the whole document in memory
+    location_regex = re.compile(r'^(.+):(\d+)$', re.M)
+    chunk_size = 65536
+
+    def __init__(self):
+        self.results = []
+        self.current = None
+        self.text = None
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+
+    @staticmethod
+    def parse(filename):
+        log = JUnitLog()
+        try:
+            f = open(filename, 'rb')
+            try:
+                while True:
+                    data = f.read(JUnitLog.chunk_size)
+                    if len(data) == 0:
+                        break
+                    log.parser.Parse(data, False)
+                log.parser.Parse(b'', True)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError, xml.parsers.expat.ExpatError):
+            Msgs.debug_msg('-- unable to parse %s', filename)
+            return None
+        return log.results
+
+    def start_element(self, name, attrs):
+        if name == 'testcase':
+            # older versions of PHPUnit only give us the dotted classname
+            classname = attrs.get('class', attrs.get('classname', '').replace('.', '\\'))
+            self.current = TestResult(classname, attrs.get('name', ''), attrs.get('file'), int(attrs.get('line', 0)))
+            self.current.time = float(attrs.get('time', 0))
+            self.current.assertions = int(attrs.get('assertions', 0))
+        elif name in ('failure', 'error', 'warning', 'skipped') and self.current is not None:
+            if not self.current.is_failed():
+                self.current.status = name
+            self.text = []
+
+    def end_element(self, name):
+        if name == 'testcase' and self.current is not None:
+            self.results.append(self.current)
+            self.current = None
+        elif name in ('failure', 'error', 'warning', 'skipped') and self.text is not None:
+            self.current.message = ''.join(self.text).strip()
+            self.text = None
+            self.locate_failure(self.current)
+
+    def character_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def locate_failure(self, result):
+        # the message ends with a stack trace; we want the line in the
+        # test itself if it is there, otherwise the first line we find
+        locations = self.location_regex.findall(result.message)
+        for filename, line in locations:
+            if filename == result.filename:
+                result.failed_file = filename
+                result.failed_line = int(line)
+                return
+        if len(locations) > 0:
+            result.failed_file = locations[0][0]
+            result.failed_line = int(locations[0][1])
+
+
+class TestResults:
+    data_set_regex = re.compile(r'( with data set |#|@).*$')
+
+    # window.id() -> [folder, configfile, results of the last run in
+    # that window]
+    last = {}
+
+    # PHPUnit's own record of which tests failed last time, and the
+    # statuses that count as failures in each place it is kept
+    result_caches = [
+        ['.phpunit.result.cache', [3, 4]],
+        [os.path.join('.phpunit.cache', 'test-results'), [7, 8]],
+    ]
+    # filename -> [mtime, names of the failed tests]
+    cached_failures = {}
+
+    @staticmethod
+    def store(window, folder, configfile, results):
+        TestResults.last[window.id()] = [folder, configfile, results]
+
+    @staticmethod
+    def lastRun(window):
+        return TestResults.last.get(window.id())
+
+    @staticmethod
+    def get(window):
+        if window.id() not in TestResults.last:
+            return []
+        return TestResults.last[window.id()][2]
+
+    @staticmethod
+    def failures(window):
+        return [x for x in TestResults.get(window) if x.is_failed()]
+
+    @staticmethod
+    def failedInCache(folder, configfile):
+        # the result cache can live alongside the config file, or in
+        # the folder that PHPUnit was run from
+        for path in [os.path.dirname(configfile), folder]:
+            for name, statuses in TestResults.result_caches:
+                filename = os.path.join(path, name)
+                mtime = ProjectFiles.getMtime(filename)
+                if mtime is None:
+                    continue
+                if filename in TestResults.cached_failures and TestResults.cached_failures[filename][0] == mtime:
+                    return TestResults.cached_failures[filename][1]
+                names = TestResults.readResultCache(filename, statuses)
+                TestResults.cached_failures[filename] = [mtime, names]
+                return names
+        return []
+
+    @staticmethod
+    def readResultCache(filename, statuses):
+        try:
+            f = open(filename, 'rb')
+            try:
+                defects = json.loads(f.read().decode('utf-8')).get('defects', {})
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError, AttributeError):
+            Msgs.debug_msg('-- unable to read %s', filename)
+            return []
+        return sorted([x for x in defects.keys() if defects[x] in statuses])
+
+    @staticmethod
+    def filterFor(names, classes=[]):
+        # PHPUnit matches --filter against "Class::method", followed by
+        # the name of the data set if the test has one; we re-run every
+        # data set of a failing test method
+        methods = []
+        for name in names:
+            method = TestResults.data_set_regex.sub('', name)
+            if method not in methods:
+                methods.append(method)
+
+        patterns = []
+        if len(methods) > 0:
+            patterns.append('^(?:' + '|'.join([TestResults.escape(x) for x in methods]) + ')\\b')
+        if len(classes) > 0:
+            # the classes can be in any namespace
+            patterns.append('(?:^|\\\\)(?:' + '|'.join([TestResults.escape(x) for x in classes]) + ')::')
+        return '/' + '|'.join(patterns) + '/'
+
+    @staticmethod
+    def escape(text):
+        # escaping every non-word character is always safe in PCRE
+        return re.sub(r'(\W)', r'\\\1', text)
+
+    @staticmethod
+    def summary(results):
+        counts = {}
+        assertions = 0
+        for result in results:
+            counts[result.status] = counts.get(result.status, 0) + 1
+            assertions += result.assertions
+
+        # we use the same wording as PHPUnit does
+        summary = ["Tests: " + str(len(results)), "Assertions: " + str(assertions)]
+        for status, name in [('error', 'Errors'), ('failure', 'Failures'), ('warning', 'Warnings'), ('skipped', 'Skipped')]:
+            if status in counts:
+                summary.append(name + ": " + str(counts[status]))
+        return ", ".join(summary)
 
 
 class FoundFiles:
+    # filename -> [result, when we last checked it exists, when it was
+    # last used], for each top folder
     cache = {}
+    # searches that found nothing, and when they were made
+    missing = {}
+    # basename -> the searches in missing that were looking for it
+    missing_names = {}
+    # ever-increasing counter, used to find the least recently used entries
+    last_used = 0
+    stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
 
     @staticmethod
     def addToCache(top_folder, filename, result):
         if top_folder not in FoundFiles.cache:
             FoundFiles.cache[top_folder] = {}
-        Msgs.debug_msg('Adding ' + result + ' to cache for ' + top_folder)
-        FoundFiles.cache[top_folder][filename] = result
+        Msgs.debug_msg('Adding %s to cache for %s', result, top_folder)
+        FoundFiles.last_used = FoundFiles.last_used + 1
+        FoundFiles.cache[top_folder][filename] = [result, datetime.datetime.now(), FoundFiles.last_used]
+        FoundFiles.evictFrom(top_folder)
+        ProjectCache.scheduleSave(top_folder)
+
+    @staticmethod
+    def evictFrom(top_folder):
+        entries = FoundFiles.cache[top_folder]
+        if len(entries) <= Prefs.cache_max_entries:
+            return
+
+        # we evict in batches, so that we are not sorting the whole
+        # cache every time that something new is added to it
+        to_evict = len(entries) - Prefs.cache_max_entries + (Prefs.cache_max_entries // 10)
+        oldest = sorted(entries.items(), key=lambda x: x[1][2])[:to_evict]
+        for filename, entry in oldest:
+            del entries[filename]
+        FoundFiles.stats['evictions'] = FoundFiles.stats['evictions'] + len(oldest)
+        Msgs.debug_msg('-- evicted %s entries from cache for %s', len(oldest), top_folder)
+
+    @staticmethod
+    def restoreCache(top_folder, results):
+        # restored entries have not been checked yet, and have not been
+        # used yet either
+        if top_folder not in FoundFiles.cache:
+            FoundFiles.cache[top_folder] = {}
+        for filename, result in results.items():
+            if filename not in FoundFiles.cache[top_folder]:
+                FoundFiles.cache[top_folder][filename] = [result, None, 0]
+        FoundFiles.evictFrom(top_folder)
+
+    @staticmethod
+    def getResults(top_folder):
+        results = {}
+        for filename, entry in list(FoundFiles.cache.get(top_folder, {}).items()):
+            results[filename] = entry[0]
+        return results
 
     @staticmethod
     def removeFromCache(top_folder, filename):
-        Msgs.debug_msg('Removing ' + filename + ' from cache for ' + top_folder)
+        Msgs.debug_msg('Removing %s from cache for %s', filename, top_folder)
         if top_folder not in FoundFiles.cache:
-            Msgs.debug_msg('-- no cache for ' + top_folder)
+            Msgs.debug_msg('-- no cache for %s', top_folder)
             return
 
         if filename not in FoundFiles.cache[top_folder]:
-            Msgs.debug_msg('-- ' + filename + ' not found in cache')
+            Msgs.debug_msg('-- %s not found in cache', filename)
             return
 
         del FoundFiles.cache[top_folder][filename]
-        Msgs.debug_msg('-- ' + filename + ' removed from cache')
+        Msgs.debug_msg('-- %s removed from cache', filename)
+
+    @staticmethod
+    def removeResult(top_folder, result):
+        if top_folder not in FoundFiles.cache:
+            return
+
+        for filename, entry in list(FoundFiles.cache[top_folder].items()):
+            if entry[0] == result:
+                FoundFiles.removeFromCache(top_folder, filename)
 
     @staticmethod
     def removeCacheFor(top_folder):
-        Msgs.debug_msg('Removing cache for ' + top_folder)
+        Msgs.debug_msg('Removing cache for %s', top_folder)
+        FoundFiles.missing.pop(top_folder, None)
+        FoundFiles.missing_names.pop(top_folder, None)
         if top_folder not in FoundFiles.cache:
-            Msgs.debug_msg('-- no cache for ' + top_folder)
+            Msgs.debug_msg('-- no cache for %s', top_folder)
             return
         del FoundFiles.cache[top_folder]
         Msgs.debug_msg('-- removed cache')
@@ -271,20 +1405,125 @@ class FoundFiles:
     def removeCache():
         Msgs.debug_msg('Completely emptying the cache')
         FoundFiles.cache = {}
+        FoundFiles.removeMissing()
+
+    @staticmethod
+    def addMissing(top_folder, search_from, files_to_find):
+        if Prefs.negative_cache_secs <= 0:
+            return
+
+        key = (search_from, tuple(files_to_find))
+        Msgs.debug_msg('Remembering that we cannot find %s', ', '.join(files_to_find))
+        if top_folder not in FoundFiles.missing:
+            FoundFiles.missing[top_folder] = {}
+            FoundFiles.missing_names[top_folder] = {}
+        FoundFiles.missing[top_folder][key] = datetime.datetime.now()
+        for filename in files_to_find:
+            basename = os.path.basename(filename)
+            if basename not in FoundFiles.missing_names[top_folder]:
+                FoundFiles.missing_names[top_folder][basename] = set()
+            FoundFiles.missing_names[top_folder][basename].add(key)
+        FoundFiles.evictMissing(top_folder)
+
+    @staticmethod
+    def evictMissing(top_folder):
+        # searches that are never made again would otherwise stay here
+        # for the rest of the session
+        entries = FoundFiles.missing[top_folder]
+        if len(entries) <= Prefs.cache_max_entries:
+            return
+
+        # the expired ones go first, and then the oldest, in a batch
+        expires = datetime.datetime.now() - datetime.timedelta(seconds=Prefs.negative_cache_secs)
+        for key, when in list(entries.items()):
+            if when < expires:
+                FoundFiles.forgetMissing(top_folder, key)
+        if len(entries) <= Prefs.cache_max_entries:
+            return
+
+        to_evict = len(entries) - Prefs.cache_max_entries + (Prefs.cache_max_entries // 10)
+        for key, when in sorted(entries.items(), key=lambda x: x[1])[:to_evict]:
+            FoundFiles.forgetMissing(top_folder, key)
+
+    @staticmethod
+    def forgetMissing(top_folder, key):
+        FoundFiles.missing[top_folder].pop(key, None)
+        names = FoundFiles.missing_names[top_folder]
+        for filename in key[1]:
+            basename = os.path.basename(filename)
+            keys = names.get(basename)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if len(keys) == 0:
+                del names[basename]
+
+    @staticmethod
+    def isMissing(top_folder, search_from, files_to_find):
+        if top_folder not in FoundFiles.missing:
+            return False
+
+        key = (search_from, tuple(files_to_find))
+        when = FoundFiles.missing[top_folder].get(key)
+        if when is None:
+            return False
+        if datetime.datetime.now() - when > datetime.timedelta(seconds=Prefs.negative_cache_secs):
+            FoundFiles.forgetMissing(top_folder, key)
+            return False
+
+        Msgs.debug_msg('-- we already know that we cannot find %s', ', '.join(files_to_find))
+        return True
+
+    @staticmethod
+    def fileAppeared(top_folder, filename):
+        # forget any failed searches that this file might now answer
+        if top_folder not in FoundFiles.missing_names:
+            return
+
+        keys = FoundFiles.missing_names[top_folder].get(os.path.basename(filename))
+        if keys is None:
+            return
+        for key in list(keys):
+            FoundFiles.forgetMissing(top_folder, key)
+
+    @staticmethod
+    def removeMissing():
+        FoundFiles.missing = {}
+        FoundFiles.missing_names = {}
 
     @staticmethod
     def getFromCache(top_folder, filename):
-        Msgs.debug_msg('Get ' + filename + ' from cache for ' + top_folder)
+        Msgs.debug_msg('Get %s from cache for %s', filename, top_folder)
+        if top_folder not in FoundFiles.cache:
+            ProjectCache.loadFound(top_folder)
         if top_folder not in FoundFiles.cache:
-            Msgs.debug_msg('-- no cache for ' + top_folder)
+            Msgs.debug_msg('-- no cache for %s', top_folder)
+            FoundFiles.stats['misses'] = FoundFiles.stats['misses'] + 1
             return None
 
-        if filename not in FoundFiles.cache[top_folder]:
-            Msgs.debug_msg('-- ' + filename + ' not found in cache')
+        entry = FoundFiles.cache[top_folder].get(filename)
+        if entry is None:
+            Msgs.debug_msg('-- %s not found in cache', filename)
+            FoundFiles.stats['misses'] = FoundFiles.stats['misses'] + 1
             return None
 
-        Msgs.debug_msg('-- found ' + FoundFiles.cache[top_folder][filename])
-        return FoundFiles.cache[top_folder][filename]
+        # is it time to make sure that the file is still there?
+        now = datetime.datetime.now()
+        if entry[1] is None or now - entry[1] > datetime.timedelta(seconds=Prefs.cache_validate_secs):
+            if not os.path.exists(entry[0]):
+                Msgs.debug_msg('-- %s no longer exists', entry[0])
+                FoundFiles.removeFromCache(top_folder, filename)
+                FoundFiles.stats['stale'] = FoundFiles.stats['stale'] + 1
+                FoundFiles.stats['misses'] = FoundFiles.stats['misses'] + 1
+                return None
+            entry[1] = now
+
+        FoundFiles.last_used = FoundFiles.last_used + 1
+        entry[2] = FoundFiles.last_used
+        FoundFiles.stats['hits'] = FoundFiles.stats['hits'] + 1
+
+        Msgs.debug_msg('-- found %s', entry[0])
+        return entry[0]
 
 
 class FindFiles:
@@ -293,23 +1532,39 @@ class FindFiles:
     last_search_time = None
 
     @staticmethod
-    def find(top_folder, search_from, files_to_find):
+    def find(top_folder, search_from, files_to_find, kind=None):
+        # kind is what we are looking for ('test', 'tested' or 'xml'), so
+        # that we can learn which stage tends to find it in this project
+        #
+        # have we looked for these recently, and not found them?
+        start = time.time()
+        if FoundFiles.isMissing(top_folder, search_from, files_to_find):
+            ResolutionStats.record(top_folder, 'missing', True, start)
+            return None
+
         for file_to_find in files_to_find:
-            Msgs.debug_msg("Looking for " + file_to_find)
+            Msgs.debug_msg("Looking for %s", file_to_find)
             # check the cache - do we already know the answer?
-            result = FindFiles.searchCacheFor(top_folder, file_to_find)
+            result = FindFiles.searchStage(top_folder, 'cache', FindFiles.searchCacheFor, top_folder, file_to_find)
             if result is not None:
                 return result
 
+            # does composer tell us exactly where it is?
+            result = FindFiles.searchStage(top_folder, 'composer', FindFiles.searchComposerFor, top_folder, file_to_find)
+            if result is not None:
+                # cache the result
+                FoundFiles.addToCache(top_folder, file_to_find, result)
+                return result
+
             # check the top folder
-            result = FindFiles.searchTopFolderFor(top_folder, file_to_find)
+            result = FindFiles.searchStage(top_folder, 'top folder', FindFiles.searchTopFolderFor, top_folder, file_to_find)
             if result is not None:
                 # cache the result
                 FoundFiles.addToCache(top_folder, file_to_find, result)
                 return result
 
             # check in the places given in hints
-            result = FindFiles.searchNamedPlacesFor(top_folder, Prefs.phpunit_xml_location_hints, file_to_find)
+            result = FindFiles.searchStage(top_folder, 'hints', FindFiles.searchNamedPlacesFor, top_folder, Prefs.phpunit_xml_location_hints, file_to_find)
             if result is not None:
                 # cache the result
                 FoundFiles.addToCache(top_folder, file_to_find, result)
@@ -317,50 +1572,126 @@ class FindFiles:
 
             # if we reach this point, we are going to have to search on disk
             dir_name = search_from
-            if not os.path.isdir(dir_name):
+            if not FolderListings.isDir(dir_name):
                 dir_name = os.path.dirname(dir_name)
 
+            # in some projects, the index answers nearly every search;
+            # there, we ask it first, as long as the answer cannot be
+            # any different to what searching upwards would give us
+            index_missed = False
+            if FindFiles.indexAnswersFirst(top_folder, kind, dir_name, file_to_find):
+                start = time.time()
+                matches = ProjectFiles.lookup(top_folder, file_to_find)
+                ResolutionStats.record(top_folder, 'index', len(matches) == 1, start)
+                if len(matches) == 1:
+                    # we still count the win for searching upwards if
+                    # that would have found it, so that we notice when
+                    # the index is no longer worth asking first
+                    if FindFiles.upwardsWouldFind(dir_name, file_to_find, matches[0]):
+                        ResolutionStats.recordWinner(top_folder, kind, 'upwards')
+                    else:
+                        ResolutionStats.recordWinner(top_folder, kind, 'index')
+                    FoundFiles.addToCache(top_folder, file_to_find, matches[0])
+                    return matches[0]
+                # the index can be a little behind what is on disk, so
+                # we still search upwards
+                index_missed = len(matches) == 0
+
             # straight-line search - fastest for most people
-            result = FindFiles.searchStraightUpwardsFor(top_folder, dir_name, file_to_find)
+            result = FindFiles.searchStage(top_folder, 'upwards', FindFiles.searchStraightUpwardsFor, top_folder, dir_name, file_to_find)
             if result is not None:
+                ResolutionStats.recordWinner(top_folder, kind, 'upwards')
                 # cache the result
                 FoundFiles.addToCache(top_folder, file_to_find, result)
                 return result
 
+            # there is no need to ask the index a second time
+            if index_missed:
+                continue
+
             # okay, so where is it?
-            result = ProjectFiles.find(top_folder, file_to_find)
+            result = FindFiles.searchStage(top_folder, 'index', ProjectFiles.find, top_folder, file_to_find, dir_name)
             if result is not None:
+                ResolutionStats.recordWinner(top_folder, kind, 'index')
                 FoundFiles.addToCache(top_folder, file_to_find, result)
                 return result
 
         # if we get here, we cannot find the file
+        FoundFiles.addMissing(top_folder, search_from, files_to_find)
         return None
 
+    @staticmethod
+    def indexAnswersFirst(top_folder, kind, dir_name, file_to_find):
+        if not ResolutionStats.prefersIndex(top_folder, kind):
+            return False
+
+        # the index must be complete ...
+        if top_folder not in ProjectFiles.files or ProjectFiles.isBuilding(top_folder):
+            return False
+
+        # ... and must include every folder that searching upwards
+        # would look in
+        if dir_name != top_folder and not dir_name.startswith(os.path.join(top_folder, '')):
+            return False
+        parts = ProjectFiles.splitPath(dir_name[len(top_folder):]) + ProjectFiles.splitPath(os.path.dirname(file_to_find))
+        for part in parts:
+            if part in Prefs.folder_exclusions:
+                return False
+        return True
+
+    @staticmethod
+    def upwardsWouldFind(dir_name, file_to_find, filename):
+        # searching upwards only looks in dir_name and the folders above
+        # it, so it finds filename if filename is inside one of those
+        folder = filename
+        for part in ProjectFiles.splitPath(file_to_find):
+            folder = os.path.dirname(folder)
+        return dir_name == folder or dir_name.startswith(os.path.join(folder, ''))
+
+    @staticmethod
+    def searchStage(top_folder, stage, search, *args):
+        start = time.time()
+        result = search(*args)
+        ResolutionStats.record(top_folder, stage, result is not None, start)
+        return result
+
     @staticmethod
     def searchCacheFor(top_folder, file_to_find):
         return FoundFiles.getFromCache(top_folder, file_to_find)
 
     @staticmethod
-    def searchNamedPlacesFor(top_folder, places, file_to_find):
+    def searchComposerFor(top_folder, file_to_find):
+        if not file_to_find.endswith('.php'):
+            return None
+
+        Msgs.debug_msg('Searching composer autoload rules for %s', file_to_find)
+        for filenameToTest in ComposerAutoload.candidates(top_folder, file_to_find):
+            Msgs.debug_msg('-- Looking for %s', filenameToTest)
+            if FolderListings.isFile(filenameToTest):
+                return filenameToTest
+        return None
+
+    @staticmethod
+    def searchNamedPlacesFor(top_folder, places, file_to_find):
         for place in places:
             pathToTest = os.path.join(top_folder, place)
             filenameToTest = os.path.join(pathToTest, file_to_find)
-            Msgs.debug_msg('Searching for file ' + filenameToTest)
-            if os.path.exists(filenameToTest):
+            Msgs.debug_msg('Searching for file %s', filenameToTest)
+            if FolderListings.exists(filenameToTest):
                 return filenameToTest
         return None
 
     @staticmethod
     def searchTopFolderFor(top_folder, file_to_find):
-        Msgs.debug_msg('Searching top folder ' + top_folder + ' for ' + file_to_find)
+        Msgs.debug_msg('Searching top folder %s for %s', top_folder, file_to_find)
         return FindFiles.searchFolderFor(top_folder, file_to_find)
 
     @staticmethod
     def searchFolderFor(folder, file_to_find):
-        Msgs.debug_msg('-- Searching ' + folder + ' for ' + file_to_find)
+        Msgs.debug_msg('-- Searching %s for %s', folder, file_to_find)
         filenameToTest = os.path.join(folder, file_to_find)
-        if os.path.exists(filenameToTest):
-            Msgs.debug_msg('---- Found ' + filenameToTest)
+        if FolderListings.exists(filenameToTest):
+            Msgs.debug_msg('---- Found %s', filenameToTest)
             return filenameToTest
         return None
 
@@ -370,7 +1701,7 @@ class FindFiles:
             return True
         hints = Prefs.folder_search_hints
         for hint in hints:
-            if os.path.exists(os.path.join(path, hint)):
+            if FolderListings.exists(os.path.join(path, hint)):
                 return True
         return False
 
@@ -391,10 +1722,10 @@ class FindFiles:
 
     @staticmethod
     def _searchStraightUpwardsFor(top_folder, oldpath, path, file_to_find):
-        Msgs.debug_msg("Looking in " + path)
+        Msgs.debug_msg("Looking in %s", path)
         filenameToTest = os.path.join(path, file_to_find)
-        Msgs.debug_msg("Looking for " + filenameToTest)
-        if os.path.exists(filenameToTest):
+        Msgs.debug_msg("Looking for %s", filenameToTest)
+        if FolderListings.exists(filenameToTest):
             return filenameToTest
 
         if FindFiles.reachedTopLevelFolder(top_folder, oldpath, path):
@@ -403,13 +1734,332 @@ class FindFiles:
         return FindFiles._searchStraightUpwardsFor(top_folder, path, os.path.dirname(path), file_to_find)
 
 
+class ResolutionStats:
+    # how well each stage of FindFiles.find() is working for us
+    #
+    # top folder -> stage -> [searches, hits, total secs, slowest secs]
+    stages = {}
+    # top folder -> kind -> {stage: how often it found the file}, for
+    # the stages that FindFiles.find() can try in either order
+    winners = {}
+    # top folder -> what was built -> [secs, how many things, when]
+    builds = {}
+    # once a kind has this many wins, we start forgetting the old ones,
+    # so that we notice when a project changes
+    max_wins = 100
+    # the order that FindFiles.find() tries the stages in
+    stage_names = ['missing', 'cache', 'composer', 'top folder', 'hints', 'upwards', 'index']
+
+    @staticmethod
+    def record(top_folder, stage, hit, start):
+        secs = time.time() - start
+        stages = ResolutionStats.stages.get(top_folder)
+        if stages is None:
+            stages = ResolutionStats.stages[top_folder] = {}
+        stats = stages.get(stage)
+        if stats is None:
+            stats = stages[stage] = [0, 0, 0.0, 0.0]
+        stats[0] += 1
+        if hit:
+            stats[1] += 1
+        stats[2] += secs
+        if secs > stats[3]:
+            stats[3] = secs
+
+    @staticmethod
+    def recordWinner(top_folder, kind, stage):
+        if kind is None:
+            return
+        if top_folder not in ResolutionStats.winners:
+            ResolutionStats.winners[top_folder] = {}
+        wins = ResolutionStats.winners[top_folder].get(kind)
+        if wins is None:
+            wins = ResolutionStats.winners[top_folder][kind] = {'upwards': 0, 'index': 0}
+        wins[stage] += 1
+        if wins['upwards'] + wins['index'] >= ResolutionStats.max_wins:
+            for key in wins:
+                wins[key] = wins[key] // 2
+
+    @staticmethod
+    def prefersIndex(top_folder, kind):
+        wins = ResolutionStats.winners.get(top_folder, {}).get(kind)
+        if wins is None:
+            return False
+        return wins['index'] > wins['upwards']
+
+    @staticmethod
+    def recordBuild(top_folder, what, start, count):
+        if top_folder not in ResolutionStats.builds:
+            ResolutionStats.builds[top_folder] = {}
+        ResolutionStats.builds[top_folder][what] = [time.time() - start, count, datetime.datetime.now()]
+
+    @staticmethod
+    def report():
+        lines = []
+        top_folders = set(ResolutionStats.stages.keys()) | set(ResolutionStats.builds.keys()) | set(ProjectFiles.files.keys())
+        for top_folder in sorted(top_folders):
+            lines.append(top_folder)
+            lines.append('')
+            lines.append('  %-12s %10s %10s %8s %12s %12s %12s' % ('stage', 'searches', 'hits', 'hit %', 'total ms', 'mean ms', 'slowest ms'))
+            stages = ResolutionStats.stages.get(top_folder, {})
+            for stage in ResolutionStats.stage_names:
+                stats = stages.get(stage)
+                if stats is None:
+                    continue
+                lines.append('  %-12s %10d %10d %7.1f%% %12.3f %12.3f %12.3f' % (stage, stats[0], stats[1], 100.0 * stats[1] / stats[0], stats[2] * 1000, stats[2] * 1000 / stats[0], stats[3] * 1000))
+            if len(stages) == 0:
+                lines.append('  (no searches yet)')
+            for kind, wins in sorted(ResolutionStats.winners.get(top_folder, {}).items()):
+                first = ResolutionStats.prefersIndex(top_folder, kind) and 'index' or 'upwards'
+                lines.append('  %-12s tried first: %s (recent wins: %d upwards, %d index)' % (kind, first, wins['upwards'], wins['index']))
+
+            lines.append('')
+            lines.append('  cached results:        %d found, %d missing' % (len(FoundFiles.cache.get(top_folder, {})), len(FoundFiles.missing.get(top_folder, {}))))
+            lines.append('  files index:           %d file(s) in %d folder(s)%s' % (len(ProjectFiles.files.get(top_folder, ())), len(ProjectFiles.folders.get(top_folder, {})), ProjectFiles.isBuilding(top_folder) and ', still building' or ''))
+            lines.append('  symbols index:         %d class(es)%s' % (len(PhpSymbols.classes.get(top_folder, {})), top_folder in PhpSymbols.scans and ', still scanning' or ''))
+            lines.append('  coverage map:          %d file(s)' % len(CoverageMap.tests.get(top_folder, {})))
+            lines.append('  test durations:        %d test(s)' % len(TestDurations.history.get(top_folder, {})))
+            for what, build in sorted(ResolutionStats.builds.get(top_folder, {}).items()):
+                lines.append('  %-22s %.3f second(s) for %d item(s), at %s' % (what + ':', build[0], build[1], build[2].strftime('%H:%M:%S')))
+            lines.append('')
+
+        lines.append('folder listings:         %d cached' % len(FolderListings.listings))
+        lines.append('cached results:          %(hits)d hit(s), %(misses)d miss(es), %(stale)d stale, %(evictions)d evicted' % FoundFiles.stats)
+        return '\n'.join(lines) + '\n'
+
+
+class ComposerAutoload:
+    # top folder -> [mtimes, PSR-4 rules, PSR-0 rules, when we last
+    # checked the mtimes]
+    #
+    # the rules are lists of (namespace prefix, folder) pairs, with the
+    # longest prefixes first
+    rules = {}
+
+    autoload_regex = re.compile(r"^\s*'((?:[^'\\]|\\.)*)'\s*=>\s*array\((.*)\),?\s*$", re.M)
+    basedir_regex = re.compile(r"\$baseDir\s*\.\s*'([^']*)'")
+
+    @staticmethod
+    def getRules(top_folder):
+        # we are asked for the rules on every lookup, so we trust them
+        # for a little while before we stat() the files again
+        now = time.time()
+        cached = ComposerAutoload.rules.get(top_folder)
+        if cached is not None and now - cached[3] < FolderListings.trust_secs:
+            return cached
+
+        composer_json = os.path.join(top_folder, 'composer.json')
+        autoload_psr4 = os.path.join(top_folder, 'vendor', 'composer', 'autoload_psr4.php')
+        mtimes = (ProjectFiles.getMtime(composer_json), ProjectFiles.getMtime(autoload_psr4))
+        if cached is not None and cached[0] == mtimes:
+            cached[3] = now
+            return cached
+
+        psr4 = []
+        psr0 = []
+        if mtimes[0] is not None:
+            ComposerAutoload.parseComposerJson(composer_json, psr4, psr0)
+        if mtimes[1] is not None:
+            ComposerAutoload.parseAutoloadPsr4(autoload_psr4, psr4)
+
+        psr4 = sorted(set(psr4), key=lambda x: (-len(x[0]), x))
+        psr0 = sorted(set(psr0), key=lambda x: (-len(x[0]), x))
+        Msgs.debug_msg('Loaded %s composer autoload rule(s) for %s', len(psr4) + len(psr0), top_folder)
+        cached = [mtimes, psr4, psr0, now]
+        ComposerAutoload.rules[top_folder] = cached
+        return cached
+
+    @staticmethod
+    def parseComposerJson(filename, psr4, psr0):
+        try:
+            f = open(filename, 'r')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            Msgs.debug_msg('-- unable to read %s', filename)
+            return
+
+        for section in ('autoload', 'autoload-dev'):
+            autoload = data.get(section, {})
+            if not isinstance(autoload, dict):
+                continue
+            for key, rules in (('psr-4', psr4), ('psr-0', psr0)):
+                for prefix, folders in autoload.get(key, {}).items():
+                    if not isinstance(folders, list):
+                        folders = [folders]
+                    for folder in folders:
+                        rules.append((prefix, folder))
+
+    @staticmethod
+    def parseAutoloadPsr4(filename, psr4):
+        # composer writes this out as PHP; we only want the rules that
+        # point inside the project itself, not the ones for vendor/
+        try:
+            f = open(filename, 'r')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            Msgs.debug_msg('-- unable to read %s', filename)
+            return
+
+        for match in ComposerAutoload.autoload_regex.finditer(text):
+            prefix = match.group(1).replace('\\\\', '\\')
+            for folder in ComposerAutoload.basedir_regex.findall(match.group(2)):
+                psr4.append((prefix, folder.lstrip('/')))
+
+    @staticmethod
+    def candidates(top_folder, file_to_find):
+        # file_to_find is the class name, turned into a path
+        rules = ComposerAutoload.getRules(top_folder)
+        classname = file_to_find[:-4].replace('/', '\\')
+
+        result = []
+        for prefix, folder in rules[1]:
+            if classname.startswith(prefix):
+                relpath = classname[len(prefix):].replace('\\', '/') + '.php'
+                result.append(os.path.normpath(os.path.join(top_folder, folder, relpath)))
+        for prefix, folder in rules[2]:
+            if classname.startswith(prefix):
+                result.append(os.path.normpath(os.path.join(top_folder, folder, file_to_find)))
+        return result
+
+
+class FolderListings:
+    # folder -> [mtime, when we last checked the mtime, set of names,
+    # set of sub-folder names]
+    #
+    # one listing of a folder answers every 'does this exist?' question
+    # about it, which matters a lot on network filesystems, where each
+    # stat() can take milliseconds
+    listings = {}
+    # how long we trust a listing before we check the folder's mtime again
+    trust_secs = 1
+    max_entries = 10000
+
+    @staticmethod
+    def get(folder):
+        now = datetime.datetime.now()
+        entry = FolderListings.listings.get(folder)
+        if entry is not None and now - entry[1] < datetime.timedelta(seconds=FolderListings.trust_secs):
+            return entry
+
+        mtime = ProjectFiles.getMtime(folder)
+        if entry is not None and entry[0] == mtime:
+            entry[1] = now
+            return entry
+
+        names = set()
+        dirs = set()
+        if mtime is not None:
+            try:
+                if hasattr(os, 'scandir'):
+                    for dir_entry in os.scandir(folder):
+                        names.add(dir_entry.name)
+                        if dir_entry.is_dir():
+                            dirs.add(dir_entry.name)
+                else:
+                    for name in os.listdir(folder):
+                        names.add(name)
+                        if os.path.isdir(os.path.join(folder, name)):
+                            dirs.add(name)
+            except OSError:
+                Msgs.debug_msg('-- unable to read folder %s', folder)
+
+        if len(FolderListings.listings) >= FolderListings.max_entries:
+            FolderListings.listings = {}
+        entry = [mtime, now, names, dirs]
+        FolderListings.listings[folder] = entry
+        return entry
+
+    @staticmethod
+    def exists(path):
+        folder, name = os.path.split(path)
+        return name in FolderListings.get(folder)[2]
+
+    @staticmethod
+    def isFile(path):
+        folder, name = os.path.split(path)
+        entry = FolderListings.get(folder)
+        return name in entry[2] and name not in entry[3]
+
+    @staticmethod
+    def isDir(path):
+        folder, name = os.path.split(path)
+        return name in FolderListings.get(folder)[3]
+
+    @staticmethod
+    def forget(folder):
+        FolderListings.listings.pop(folder, None)
+
+    @staticmethod
+    def removeListings():
+        FolderListings.listings = {}
+
+
 class ProjectFiles:
     files = {}
+    # basename -> the file with that basename, or a list of them if
+    # there is more than one, for each top folder
+    #
+    # most basenames only belong to a file or two, so lookups that
+    # include some of the folders (e.g. 'Foo/BarTest.php') just check
+    # each of those files; the paths are the same strings that are in
+    # files, so this costs little more memory than the file list itself
+    basenames = {}
+    # folder -> [mtime, set of filenames, set of sub-folder names], for
+    # each top folder; this is what lets us keep the index up to date
+    # without walking the whole project again
+    folders = {}
     last_built_time = None
 
+    # the settings that each index was built with, keyed on top folder;
+    # if they change, the index has to be built again
+    built_with = {}
+
+    # background builds in progress, keyed on top folder
+    builds = {}
+    # the current background sweep, keyed on top folder
+    sweeps = {}
+
+    @staticmethod
+    def indexSettings():
+        # the settings that change which files end up in the index
+        return {'folder_exclusions': sorted(Prefs.folder_exclusions)}
+
+    @staticmethod
+    def isStale(path):
+        if path not in ProjectFiles.built_with:
+            return False
+        return ProjectFiles.built_with[path] != ProjectFiles.indexSettings()
+
+    @staticmethod
+    def removeIndex(path):
+        Msgs.debug_msg('Removing index for %s', path)
+        ProjectFiles.files.pop(path, None)
+        ProjectFiles.basenames.pop(path, None)
+        ProjectFiles.folders.pop(path, None)
+        ProjectFiles.built_with.pop(path, None)
+        ProjectFiles.builds.pop(path, None)
+        ProjectFiles.sweeps.pop(path, None)
+        PhpSymbols.removeIndex(path)
+
+    @staticmethod
+    def rebuild(path):
+        # throws away everything that we know about the project, in
+        # memory and on disk, and starts again
+        FoundFiles.removeCacheFor(path)
+        ProjectFiles.removeIndex(path)
+        ProjectCache.remove(path, '.found')
+        ProjectCache.remove(path, '.index')
+        ProjectFiles.buildFilesList(path)
+
     @staticmethod
     def buildFilesList(path):
-        Msgs.debug_msg('Building list of files under ' + path)
+        Msgs.debug_msg('Building list of files under %s', path)
         # does the path exist?
         if not os.path.exists(path):
             return None
@@ -418,59 +2068,1017 @@ class ProjectFiles:
         if path == os.path.dirname(path):
             return None
 
-        ProjectFiles.files[path] = []
+        ProjectFiles.files[path] = set()
+        ProjectFiles.basenames[path] = {}
+        ProjectFiles.folders[path] = {}
+        ProjectFiles.built_with[path] = ProjectFiles.indexSettings()
+
+        # we're going to build up a cache of the files inside this project
+        #
+        # this can take a long time on large projects, so we do the work
+        # in the background, one time-limited slice at a time, and publish
+        # what we have found so far after each slice
+        build = {
+            'pending': [path],
+            'count': 0,
+            'start': datetime.datetime.now(),
+            'started': time.time(),
+            'publish': datetime.datetime.now(),
+        }
+        ProjectFiles.builds[path] = build
+        Background.run(functools.partial(ProjectFiles.buildSlice, path, build))
+
+    @staticmethod
+    def buildSlice(path, build):
+        # has someone started another build of this folder since?
+        if ProjectFiles.builds.get(path) is not build:
+            return
+
+        deadline = Background.deadline()
+        pending = build['pending']
+        while len(pending) > 0 and datetime.datetime.now() < deadline:
+            # the cache may have been flushed while we were working
+            if ProjectFiles.builds.get(path) is not build:
+                return
+            build['count'] = build['count'] + ProjectFiles.indexFolder(path, pending.pop(), pending)
+
+        if ProjectFiles.builds.get(path) is not build:
+            return
+
+        now = datetime.datetime.now()
+        if len(pending) > 0:
+            # publish what we have so far, every max_search_secs
+            if now >= build['publish']:
+                build['publish'] = now + datetime.timedelta(seconds=Prefs.max_search_secs)
+                ProjectFiles.last_built_time = now
+                Background.status_message('PHPUnit: indexing ' + path + ' ... ' + str(build['count']) + ' file(s) so far')
+            Background.run(functools.partial(ProjectFiles.buildSlice, path, build))
+            return
+
+        del ProjectFiles.builds[path]
+        ProjectFiles.last_built_time = now
+        duration = (now - build['start'])
+        Msgs.debug_msg('-- took %d.%06d second(s) to build', duration.seconds, duration.microseconds)
+        Msgs.debug_msg('-- found %s file(s)', build['count'])
+        ResolutionStats.recordBuild(path, 'files index build', build['started'], build['count'])
+        Background.status_message('PHPUnit: indexed ' + str(build['count']) + ' file(s) in ' + path)
+
+        ProjectCache.scheduleSave(path)
+        ProjectFiles.scheduleSweep(path)
+        PhpSymbols.buildIndex(path)
+
+    @staticmethod
+    def indexFolder(top_folder, folder, pending):
+        # we take the mtime first, so that anything which changes while
+        # we are looking will be picked up by the next sweep
+        mtime = ProjectFiles.getMtime(folder)
+        dirs, files = ProjectFiles.scanFolder(folder)
+
+        # skip over sub-folders that we do not want to visit
+        dirs = [dirname for dirname in dirs if dirname not in Prefs.folder_exclusions]
+        ProjectFiles.folders[top_folder][folder] = [mtime, set(files), set(dirs)]
+
+        for dirname in dirs:
+            pending.append(os.path.join(folder, dirname))
+        # add the files that we have
+        for name in files:
+            ProjectFiles.addToIndex(top_folder, os.path.join(folder, name))
+        return len(files)
+
+    @staticmethod
+    def refreshFolder(top_folder, folder, pending):
+        record = ProjectFiles.folders[top_folder].get(folder)
+        if record is None:
+            return ProjectFiles.indexFolder(top_folder, folder, pending)
+
+        mtime = ProjectFiles.getMtime(folder)
+        if mtime is None:
+            ProjectFiles.removeFolder(top_folder, folder)
+            return 0
+
+        dirs, files = ProjectFiles.scanFolder(folder)
+        files = set(files)
+        dirs = set([dirname for dirname in dirs if dirname not in Prefs.folder_exclusions])
+
+        for name in files - record[1]:
+            ProjectFiles.addToIndex(top_folder, os.path.join(folder, name))
+        for name in record[1] - files:
+            ProjectFiles.removeFromIndex(top_folder, os.path.join(folder, name))
+        for dirname in record[2] - dirs:
+            ProjectFiles.removeFolder(top_folder, os.path.join(folder, dirname))
+        for dirname in dirs - record[2]:
+            pending.append(os.path.join(folder, dirname))
+
+        changes = len(files ^ record[1])
+        record[:] = [mtime, files, dirs]
+        return changes
+
+    @staticmethod
+    def removeFolder(top_folder, folder):
+        record = ProjectFiles.folders[top_folder].pop(folder, None)
+        if record is None:
+            return
+        for name in record[1]:
+            ProjectFiles.removeFromIndex(top_folder, os.path.join(folder, name))
+        for dirname in record[2]:
+            ProjectFiles.removeFolder(top_folder, os.path.join(folder, dirname))
+
+    @staticmethod
+    def scheduleSweep(path, delay=None):
+        # a sweep that is asked for with a delay always happens (e.g. to
+        # check an index that we have loaded from disk); the regular
+        # sweeps can be switched off
+        if delay is None:
+            if Prefs.index_sweep_secs <= 0:
+                return
+            delay = Prefs.index_sweep_secs * 1000
+
+        sweep = {}
+        ProjectFiles.sweeps[path] = sweep
+        Background.run(functools.partial(ProjectFiles.sweepSlice, path, sweep), delay)
+
+    @staticmethod
+    def sweepSlice(path, sweep):
+        # has this sweep been replaced, or the index thrown away?
+        if ProjectFiles.sweeps.get(path) is not sweep or path not in ProjectFiles.folders:
+            return
+        if ProjectFiles.isBuilding(path):
+            return
+
+        if 'folders' not in sweep:
+            Msgs.debug_msg('Sweeping for changes under %s', path)
+            sweep['folders'] = list(ProjectFiles.folders[path].keys())
+            sweep['pending'] = []
+            sweep['changes'] = 0
+
+        # we only look inside the folders that have changed since last time
+        deadline = Background.deadline()
+        folders = sweep['folders']
+        pending = sweep['pending']
+        while (len(folders) > 0 or len(pending) > 0) and datetime.datetime.now() < deadline:
+            if ProjectFiles.sweeps.get(path) is not sweep or path not in ProjectFiles.folders:
+                return
+            if len(pending) > 0:
+                sweep['changes'] = sweep['changes'] + ProjectFiles.indexFolder(path, pending.pop(), pending)
+                continue
+            folder = folders.pop()
+            record = ProjectFiles.folders[path].get(folder)
+            if record is None or record[0] == ProjectFiles.getMtime(folder):
+                continue
+            sweep['changes'] = sweep['changes'] + ProjectFiles.refreshFolder(path, folder, pending)
+
+        if len(folders) > 0 or len(pending) > 0:
+            Background.run(functools.partial(ProjectFiles.sweepSlice, path, sweep))
+            return
+
+        if sweep['changes'] > 0:
+            Msgs.debug_msg('-- sweep found %s change(s) under %s', sweep['changes'], path)
+            ProjectFiles.last_built_time = datetime.datetime.now()
+            ProjectCache.scheduleSave(path)
+
+        ProjectFiles.scheduleSweep(path)
+
+    @staticmethod
+    def addFile(filename):
+        FolderListings.forget(os.path.dirname(filename))
+        top_folder = ProjectFiles.topFolderFor(filename)
+        if top_folder is None or ProjectFiles.isBuilding(top_folder):
+            return
+
+        folder = os.path.dirname(filename)
+        record = ProjectFiles.folders[top_folder].get(folder)
+        if record is not None:
+            name = os.path.basename(filename)
+            if name in record[1]:
+                return
+            Msgs.debug_msg('Adding %s to ProjectFiles cache', filename)
+            record[1].add(name)
+            ProjectFiles.addToIndex(top_folder, filename)
+            ProjectFiles.last_built_time = datetime.datetime.now()
+            return
+
+        # the file is in a folder that we have not seen before
+        #
+        # we pick it up by refreshing the nearest folder that we do
+        # know about; this also skips folders that we have excluded
+        while folder not in ProjectFiles.folders[top_folder]:
+            if folder == top_folder or folder == os.path.dirname(folder):
+                return
+            folder = os.path.dirname(folder)
+
+        pending = []
+        ProjectFiles.refreshFolder(top_folder, folder, pending)
+        while len(pending) > 0:
+            ProjectFiles.indexFolder(top_folder, pending.pop(), pending)
+        ProjectFiles.last_built_time = datetime.datetime.now()
+
+    @staticmethod
+    def removeFile(filename):
+        FolderListings.forget(os.path.dirname(filename))
+        top_folder = ProjectFiles.topFolderFor(filename)
+        if top_folder is None or ProjectFiles.isBuilding(top_folder):
+            return
+
+        record = ProjectFiles.folders[top_folder].get(os.path.dirname(filename))
+        name = os.path.basename(filename)
+        if record is None or name not in record[1]:
+            return
+
+        Msgs.debug_msg('Removing %s from ProjectFiles cache', filename)
+        record[1].discard(name)
+        ProjectFiles.removeFromIndex(top_folder, filename)
+        ProjectFiles.last_built_time = datetime.datetime.now()
+
+    @staticmethod
+    def topFolderFor(filename):
+        result = None
+        for top_folder in list(ProjectFiles.folders.keys()):
+            if not filename.startswith(os.path.join(top_folder, '')):
+                continue
+            if result is None or len(top_folder) > len(result):
+                result = top_folder
+        return result
+
+    @staticmethod
+    def getMtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    @staticmethod
+    def isBuilding(path):
+        return path in ProjectFiles.builds
+
+    @staticmethod
+    def scanFolder(folder):
+        # we do not follow symlinks to folders, just like os.walk()
+        dirs = []
+        files = []
+        try:
+            if hasattr(os, 'scandir'):
+                for entry in os.scandir(folder):
+                    if not entry.is_dir():
+                        files.append(entry.name)
+                    elif not entry.is_symlink():
+                        dirs.append(entry.name)
+            else:
+                for name in os.listdir(folder):
+                    filename = os.path.join(folder, name)
+                    if not os.path.isdir(filename):
+                        files.append(name)
+                    elif not os.path.islink(filename):
+                        dirs.append(name)
+        except OSError:
+            Msgs.debug_msg('-- unable to read folder %s', folder)
+        return dirs, files
+
+    @staticmethod
+    def splitPath(path):
+        return [x for x in re.split(r'[\\/]+', path) if x != '']
+
+    @staticmethod
+    def addToIndex(top_folder, filename):
+        ProjectFiles.files[top_folder].add(filename)
+        FoundFiles.fileAppeared(top_folder, filename)
+        PhpSymbols.fileChanged(top_folder, filename)
+
+        basenames = ProjectFiles.basenames[top_folder]
+        basename = os.path.basename(filename)
+        bucket = basenames.get(basename)
+        if bucket is None:
+            basenames[basename] = filename
+        elif isinstance(bucket, list):
+            if filename not in bucket:
+                bucket.append(filename)
+        elif bucket != filename:
+            basenames[basename] = [bucket, filename]
+
+    @staticmethod
+    def removeFromIndex(top_folder, filename):
+        ProjectFiles.files[top_folder].discard(filename)
+
+        basenames = ProjectFiles.basenames[top_folder]
+        basename = os.path.basename(filename)
+        bucket = basenames.get(basename)
+        if bucket == filename:
+            del basenames[basename]
+        elif isinstance(bucket, list) and filename in bucket:
+            bucket.remove(filename)
+            if len(bucket) == 1:
+                basenames[basename] = bucket[0]
+
+        # make sure that no-one is handed this file again
+        FoundFiles.removeResult(top_folder, filename)
+        PhpSymbols.forgetFile(top_folder, filename)
+
+    @staticmethod
+    def lookup(top_folder, filename):
+        parts = ProjectFiles.splitPath(filename)
+        if len(parts) == 0:
+            return []
+
+        bucket = ProjectFiles.basenames[top_folder].get(parts[-1])
+        if bucket is None:
+            return []
+        if not isinstance(bucket, list):
+            bucket = [bucket]
+        if len(parts) == 1:
+            return list(bucket)
+
+        # the folders have to match too, and they have to be inside
+        # the top folder
+        result = []
+        for path in bucket:
+            if ProjectFiles.splitPath(path[len(top_folder):])[-len(parts):] == parts:
+                result.append(path)
+        return result
+
+    @staticmethod
+    def sortByDistance(paths, near=None):
+        # shortest path wins, unless we know where the user is working,
+        # in which case the file sharing the most folders with them wins
+        if near is None:
+            return sorted(paths, key=lambda x: (len(x), x))
+
+        near_parts = ProjectFiles.splitPath(near)
+
+        def distance(path):
+            parts = ProjectFiles.splitPath(os.path.dirname(path))
+            shared = 0
+            for a, b in zip(parts, near_parts):
+                if a != b:
+                    break
+                shared = shared + 1
+            return (len(parts) + len(near_parts) - (2 * shared), len(path), path)
+
+        return sorted(paths, key=distance)
+
+    @staticmethod
+    def find(top_folder, filename, near=None):
+        Msgs.debug_msg('Searching ProjectFiles cache for %s', filename)
+        if top_folder not in ProjectFiles.files:
+            Msgs.debug_msg('-- no cache for %s', top_folder)
+            ProjectCache.loadIndex(top_folder)
+            return None
+
+        result = ProjectFiles.lookup(top_folder, filename)
+        if len(result) == 0:
+            Msgs.debug_msg('-- none found')
+            return None
+        result = ProjectFiles.sortByDistance(result, near)
+        Msgs.debug_msg('-- found %s', result[0])
+        return result[0]
+
+    @staticmethod
+    def expired(when):
+        if when is None:
+            return True
+        if when < ProjectFiles.last_built_time:
+            return True
+        return False
+
+
+class ProjectRoots:
+    # window folders -> {folder: the top folder of its project}
+    #
+    # every folder that we pass through on the way up is remembered, so
+    # that sibling files (and files further down) can reuse the walk
+    roots = {}
+    max_windows = 16
+
+    @staticmethod
+    def find(folders, path):
+        # if the user adds or removes folders from the window, the
+        # answers can change, so we keep separate answers for each
+        # set of folders
+        key = tuple(folders)
+        if key not in ProjectRoots.roots:
+            if len(ProjectRoots.roots) >= ProjectRoots.max_windows:
+                ProjectRoots.roots = {}
+            ProjectRoots.roots[key] = {}
+        known = ProjectRoots.roots[key]
+
+        visited = []
+        while path not in known:
+            visited.append(path)
+            parent = os.path.dirname(path)
+            # we stop at the first folder that is open in the window,
+            # or that looks like the top of a project; if we find
+            # neither, we end up at the root of the filesystem
+            if path in folders or parent == path or ProjectRoots.hasHints(path):
+                known[path] = path
+                break
+            path = parent
+
+        top_folder = known[path]
+        for folder in visited:
+            known[folder] = top_folder
+        return top_folder
+
+    @staticmethod
+    def hasHints(folder):
+        for hint in Prefs.folder_search_hints:
+            if FolderListings.exists(os.path.join(folder, hint)):
+                return True
+        return False
+
+    @staticmethod
+    def removeRoots():
+        ProjectRoots.roots = {}
+
+
+class PhpSymbols:
+    # fully-qualified class name -> filename, for each top folder
+    #
+    # this lets us go straight to a test class (or the class that it
+    # tests) without having to guess where it is on disk, which matters
+    # for projects that do not follow PSR-0 or PSR-4
+    classes = {}
+    # filename -> the classes declared in that file, for each top folder
+    declared = {}
+    # the current background scan, keyed on top folder
+    scans = {}
+
+    namespace_regex = re.compile(r'^\s*namespace\s+([A-Za-z0-9_\\]+)\s*[;{]', re.M)
+    class_regex = re.compile(r'^\s*(?:(?:abstract|final|readonly)\s+)*(?:class|interface|trait|enum)\s+([A-Za-z0-9_]+)', re.M)
+
+    @staticmethod
+    def buildIndex(top_folder):
+        if top_folder not in ProjectFiles.files:
+            return
+
+        PhpSymbols.classes[top_folder] = {}
+        PhpSymbols.declared[top_folder] = {}
+        scan = {
+            'pending': [x for x in list(ProjectFiles.files[top_folder]) if x.endswith('.php')],
+            'started': time.time(),
+        }
+        PhpSymbols.scans[top_folder] = scan
+        Background.run(functools.partial(PhpSymbols.scanSlice, top_folder, scan))
+
+    @staticmethod
+    def removeIndex(top_folder):
+        PhpSymbols.classes.pop(top_folder, None)
+        PhpSymbols.declared.pop(top_folder, None)
+        PhpSymbols.scans.pop(top_folder, None)
+
+    @staticmethod
+    def scanSlice(top_folder, scan):
+        if PhpSymbols.scans.get(top_folder) is not scan:
+            return
+
+        deadline = Background.deadline()
+        pending = scan['pending']
+        while len(pending) > 0 and datetime.datetime.now() < deadline:
+            # the index may have been thrown away while we were working
+            if PhpSymbols.scans.get(top_folder) is not scan:
+                return
+            PhpSymbols.scanFile(top_folder, pending.pop())
+
+        if PhpSymbols.scans.get(top_folder) is not scan:
+            return
+        if len(pending) > 0:
+            Background.run(functools.partial(PhpSymbols.scanSlice, top_folder, scan))
+            return
+
+        del PhpSymbols.scans[top_folder]
+        Msgs.debug_msg('Found %s PHP class(es) under %s', len(PhpSymbols.classes[top_folder]), top_folder)
+        ResolutionStats.recordBuild(top_folder, 'symbols index build', scan['started'], len(PhpSymbols.classes[top_folder]))
+
+    @staticmethod
+    def scanFile(top_folder, filename):
+        # the declarations we want are always near the top of the file,
+        # so there is no need to read all of it
+        try:
+            f = open(filename, 'rb')
+            try:
+                head = f.read(Prefs.symbol_scan_bytes)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            head = b''
+
+        PhpSymbols.forgetFile(top_folder, filename)
+        declared = PhpSymbols.parse(head.decode('utf-8', 'replace'))
+        for fq_classname in declared:
+            PhpSymbols.classes[top_folder][fq_classname] = filename
+        PhpSymbols.declared[top_folder][filename] = declared
+
+    @staticmethod
+    def parse(text):
+        declarations = []
+        for match in PhpSymbols.namespace_regex.finditer(text):
+            declarations.append((match.start(), 'namespace', match.group(1)))
+        for match in PhpSymbols.class_regex.finditer(text):
+            declarations.append((match.start(), 'class', match.group(1)))
+        declarations.sort()
+
+        namespace = ''
+        result = []
+        for pos, kind, name in declarations:
+            if kind == 'namespace':
+                namespace = name
+            elif namespace != '':
+                result.append(namespace + '\\' + name)
+            else:
+                result.append(name)
+        return result
+
+    @staticmethod
+    def forgetFile(top_folder, filename):
+        if top_folder not in PhpSymbols.declared:
+            return
+        for fq_classname in PhpSymbols.declared[top_folder].pop(filename, []):
+            if PhpSymbols.classes[top_folder].get(fq_classname) == filename:
+                del PhpSymbols.classes[top_folder][fq_classname]
+
+    @staticmethod
+    def fileChanged(top_folder, filename):
+        # keeps us up to date as the ProjectFiles cache changes
+        if top_folder not in PhpSymbols.classes or not filename.endswith('.php'):
+            return
+        # a fresh scan will follow once the ProjectFiles cache is built
+        if ProjectFiles.isBuilding(top_folder):
+            return
+        if os.path.exists(filename):
+            PhpSymbols.scanFile(top_folder, filename)
+        else:
+            PhpSymbols.forgetFile(top_folder, filename)
+
+    @staticmethod
+    def fileSaved(filename):
+        top_folder = ProjectFiles.topFolderFor(filename)
+        if top_folder is not None:
+            PhpSymbols.fileChanged(top_folder, filename)
+
+    @staticmethod
+    def find(top_folder, candidates):
+        if top_folder not in PhpSymbols.classes:
+            return None
+        for fq_classname in candidates:
+            filename = PhpSymbols.classes[top_folder].get(fq_classname)
+            if filename is not None:
+                Msgs.debug_msg('-- %s is declared in %s', fq_classname, filename)
+                return filename
+        return None
+
+    @staticmethod
+    def findTestClass(top_folder, fq_classname):
+        if fq_classname is None:
+            return None
+
+        # tests often live in a namespace of their own, with an extra
+        # 'Tests' somewhere in the namespace
+        parts = fq_classname.split('\\')
+        candidates = [fq_classname + 'Test']
+        for i in range(0, len(parts)):
+            candidates.append('\\'.join(parts[:i] + ['Tests'] + parts[i:]) + 'Test')
+        return PhpSymbols.find(top_folder, candidates)
+
+    @staticmethod
+    def findTestedClass(top_folder, fq_classname):
+        if fq_classname is None or not fq_classname.endswith('Test'):
+            return None
+
+        fq_classname = fq_classname[:-4]
+        parts = fq_classname.split('\\')
+        candidates = [fq_classname]
+        for i in range(0, len(parts) - 1):
+            if parts[i] in ('Test', 'Tests'):
+                candidates.append('\\'.join(parts[:i] + parts[i + 1:]))
+        return PhpSymbols.find(top_folder, candidates)
+
+
+class ProjectCache:
+    # we keep the ProjectFiles and FoundFiles caches on disk between
+    # sessions, so that a restarted editor does not have to search the
+    # whole project again
+    #
+    # the FoundFiles cache is small, and is loaded as soon as we need it
+    # the ProjectFiles cache can be large, and is loaded in the background
+    version = 1
+    # the header is followed by a line holding the settings that the
+    # index was built with; an index built with different settings is
+    # no use to us
+    header = b'PHPUnit-index 2\n'
+    loaded = set()
+    saves = {}
+
+    @staticmethod
+    def filename(top_folder, ext):
+        # ST2 has no cache folder for us to use
+        if not Prefs.persist_index or not hasattr(sublime, 'cache_path'):
+            return None
+
+        key = top_folder
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return os.path.join(sublime.cache_path(), 'PHPUnit', hashlib.md5(key).hexdigest() + ext)
+
+    @staticmethod
+    def scheduleSave(top_folder):
+        # lots of small changes tend to arrive together, so we wait a
+        # few seconds and write them all out at once
+        if ProjectCache.filename(top_folder, '.index') is None:
+            return
+
+        save = {}
+        ProjectCache.saves[top_folder] = save
+        Background.run(functools.partial(ProjectCache.save, top_folder, save), 5000)
+
+    @staticmethod
+    def save(top_folder, save):
+        if ProjectCache.saves.get(top_folder) is not save:
+            return
+        del ProjectCache.saves[top_folder]
+
+        ProjectCache.write(top_folder, '.found', json.dumps({
+            'version': ProjectCache.version,
+            'top': top_folder,
+            'found': FoundFiles.getResults(top_folder),
+        }).encode('utf-8'))
+
+        if top_folder in CoverageMap.tests:
+            coverage = {}
+            for filename, names in list(CoverageMap.tests[top_folder].items()):
+                coverage[filename] = list(names)
+            ProjectCache.write(top_folder, '.coverage', json.dumps({
+                'version': ProjectCache.version,
+                'top': top_folder,
+                'coverage': coverage,
+            }).encode('utf-8'))
+
+        # we cannot save a half-built index
+        if top_folder not in ProjectFiles.folders or ProjectFiles.isBuilding(top_folder):
+            return
+
+        folders = []
+        for folder, record in list(ProjectFiles.folders[top_folder].items()):
+            folders.append([folder[len(top_folder) + 1:], record[0], list(record[1]), list(record[2])])
+        body = json.dumps({
+            'version': ProjectCache.version,
+            'top': top_folder,
+            'folders': folders,
+        }, separators=(',', ':'))
+        settings = ProjectFiles.built_with.get(top_folder, ProjectFiles.indexSettings())
+        ProjectCache.write(top_folder, '.index', ProjectCache.indexHeader(settings) + zlib.compress(body.encode('utf-8')))
+        Msgs.debug_msg('Saved index of %s folder(s) for %s', len(folders), top_folder)
+
+    @staticmethod
+    def indexHeader(settings):
+        return ProjectCache.header + json.dumps(settings, sort_keys=True).encode('utf-8') + b'\n'
+
+    @staticmethod
+    def write(top_folder, ext, data):
+        filename = ProjectCache.filename(top_folder, ext)
+        tmp_filename = filename + '.tmp'
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            f = open(tmp_filename, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            # Windows will not rename over the top of an existing file
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            Msgs.debug_msg('-- unable to write %s', filename)
+
+    @staticmethod
+    def append(top_folder, ext, data):
+        filename = ProjectCache.filename(top_folder, ext)
+        if filename is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            f = open(filename, 'ab')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            Msgs.debug_msg('-- unable to write %s', filename)
+
+    @staticmethod
+    def remove(top_folder, ext):
+        filename = ProjectCache.filename(top_folder, ext)
+        if filename is None or not os.path.exists(filename):
+            return
+        try:
+            os.remove(filename)
+        except OSError:
+            Msgs.debug_msg('-- unable to remove %s', filename)
+
+    @staticmethod
+    def read(top_folder, ext):
+        filename = ProjectCache.filename(top_folder, ext)
+        if filename is None or not os.path.isfile(filename):
+            return None
+        try:
+            f = open(filename, 'rb')
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            Msgs.debug_msg('-- unable to read %s', filename)
+            return None
+
+    @staticmethod
+    def decode(top_folder, data):
+        try:
+            data = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+        if data.get('version') != ProjectCache.version or data.get('top') != top_folder:
+            return None
+        return data
+
+    @staticmethod
+    def loadFound(top_folder):
+        # we only ever try once per session
+        if (top_folder, '.found') in ProjectCache.loaded:
+            return
+        ProjectCache.loaded.add((top_folder, '.found'))
+
+        data = ProjectCache.read(top_folder, '.found')
+        if data is None:
+            return
+        data = ProjectCache.decode(top_folder, data)
+        if data is None:
+            return
+
+        # the files may have moved since we last ran, but FoundFiles
+        # checks that for itself before it hands out any of these
+        Msgs.debug_msg('Loaded %s cached result(s) for %s', len(data['found']), top_folder)
+        FoundFiles.restoreCache(top_folder, data['found'])
+
+    @staticmethod
+    def loadCoverage(top_folder):
+        # we only ever try once per session
+        if (top_folder, '.coverage') in ProjectCache.loaded:
+            return
+        ProjectCache.loaded.add((top_folder, '.coverage'))
+
+        data = ProjectCache.read(top_folder, '.coverage')
+        if data is None:
+            return
+        data = ProjectCache.decode(top_folder, data)
+        if data is None or top_folder in CoverageMap.tests:
+            return
+
+        Msgs.debug_msg('Loaded coverage map of %s file(s) for %s', len(data['coverage']), top_folder)
+        CoverageMap.restore(top_folder, data['coverage'])
+
+    @staticmethod
+    def loadDurations(top_folder):
+        # we only ever try once per session
+        if (top_folder, '.durations') in ProjectCache.loaded:
+            return
+        ProjectCache.loaded.add((top_folder, '.durations'))
+
+        data = ProjectCache.read(top_folder, '.durations')
+        if data is None:
+            return
+        for line in data.decode('utf-8', 'replace').split('\n'):
+            # a line may have been cut short if we were stopped part-way
+            # through writing it
+            try:
+                line = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(line, dict):
+                TestDurations.restore(top_folder, line)
+
+    @staticmethod
+    def loadIndex(top_folder):
+        # we only ever try once per session
+        if (top_folder, '.index') in ProjectCache.loaded:
+            return False
+        ProjectCache.loaded.add((top_folder, '.index'))
+
+        if ProjectCache.filename(top_folder, '.index') is None:
+            return False
+        if not os.path.isfile(ProjectCache.filename(top_folder, '.index')):
+            return False
+        if top_folder in ProjectFiles.folders or ProjectFiles.isBuilding(top_folder):
+            return False
+
+        build = {'restoring': True}
+        ProjectFiles.builds[top_folder] = build
+        Background.run(functools.partial(ProjectCache.restoreIndex, top_folder, build))
+        return True
+
+    @staticmethod
+    def restoreIndex(top_folder, build):
+        if ProjectFiles.builds.get(top_folder) is not build:
+            return
+
+        start = time.time()
+        settings = ProjectFiles.indexSettings()
+        header = ProjectCache.indexHeader(settings)
+        data = ProjectCache.read(top_folder, '.index')
+        if data is not None and data.startswith(header):
+            try:
+                data = ProjectCache.decode(top_folder, zlib.decompress(data[len(header):]))
+            except zlib.error:
+                data = None
+        else:
+            data = None
+
+        # is the saved index usable?
+        if data is None or not os.path.isdir(top_folder):
+            Msgs.debug_msg('-- saved index for %s is unusable', top_folder)
+            if ProjectFiles.builds.get(top_folder) is not build:
+                return
+            del ProjectFiles.builds[top_folder]
+            ProjectCache.remove(top_folder, '.index')
+            ProjectFiles.buildFilesList(top_folder)
+            return
+
+        if ProjectFiles.builds.get(top_folder) is not build:
+            return
+        ProjectFiles.files[top_folder] = set()
+        ProjectFiles.basenames[top_folder] = {}
+        ProjectFiles.folders[top_folder] = {}
+        ProjectFiles.built_with[top_folder] = settings
+        build['pending'] = data['folders']
+        build['started'] = start
+        ProjectCache.restoreSlice(top_folder, build)
+
+    @staticmethod
+    def restoreSlice(top_folder, build):
+        deadline = Background.deadline()
+        pending = build['pending']
+        while len(pending) > 0 and datetime.datetime.now() < deadline:
+            # the cache may have been flushed while we were working
+            if ProjectFiles.builds.get(top_folder) is not build:
+                return
+            relpath, mtime, files, dirs = pending.pop()
+            folder = top_folder
+            if relpath != '':
+                folder = os.path.join(top_folder, relpath)
+            ProjectFiles.folders[top_folder][folder] = [mtime, set(files), set(dirs)]
+            for name in files:
+                ProjectFiles.addToIndex(top_folder, os.path.join(folder, name))
+
+        if ProjectFiles.builds.get(top_folder) is not build:
+            return
+        if len(pending) > 0:
+            Background.run(functools.partial(ProjectCache.restoreSlice, top_folder, build))
+            return
+
+        del ProjectFiles.builds[top_folder]
+        ProjectFiles.last_built_time = datetime.datetime.now()
+        Msgs.debug_msg('Restored index of %s folder(s) for %s', len(ProjectFiles.folders[top_folder]), top_folder)
+        ResolutionStats.recordBuild(top_folder, 'saved index load', build['started'], len(ProjectFiles.files[top_folder]))
+
+        # anything that has changed since the index was saved will have
+        # a different mtime, and a sweep will find and re-scan it
+        ProjectFiles.scheduleSweep(top_folder, 0)
+        PhpSymbols.buildIndex(top_folder)
 
-        # how long will this take? let's find out
-        start = datetime.datetime.now()
 
-        # we're going to build up a cache of the files inside this project
-        i = 0
-        for root, dirs, files in os.walk(path):
-            # skip over sub-folders that we do not want to visit
-            for dirname in dirs:
-                if dirname in Prefs.folder_exclusions:
-                    dirs.remove(dirname)
-            # add the files that we have
-            for name in files:
-                ProjectFiles.files[path].append(os.path.join(root, name))
-                # Msgs.debug_msg("  -- found file " + os.path.join(root, name))
-                i = i + 1
+class TestAtCursor:
+    # works out which test method, and which of its data sets, the
+    # caret is inside
+    function_regex = re.compile(r'function\s+&?\s*(\w+)\s*\(')
+    test_regex = re.compile(r'@test\b|#\[\s*\\?(?:PHPUnit\\Framework\\Attributes\\)?Test\s*[\],]')
+    provider_regex = re.compile(r'@dataProvider\s+(\w+)|#\[\s*\\?(?:PHPUnit\\Framework\\Attributes\\)?DataProvider\s*\(\s*[\'"](\w+)[\'"]')
+    token_regex = re.compile(r'''(?P<comment>//[^\n]*|\#(?!\[)[^\n]*|/\*.*?\*/)|(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(?P<word>\w+)|(?P<arrow>=>)|(?P<open>[\[\(\{])|(?P<close>[\]\)\}])|(?P<comma>,)|(?P<semicolon>;)''', re.S)
 
-        end = datetime.datetime.now()
-        duration = (end - start)
-        Msgs.debug_msg('-- took ' + str(duration.seconds) + '.' + str(duration.microseconds) + ' second(s) to build')
-        Msgs.debug_msg('-- found ' + str(i) + ' file(s)')
-        # print ProjectFiles.files[path]
-        ProjectFiles.last_built_time = end
+    @staticmethod
+    def find(text, point):
+        # returns (method, data set), where the data set is None, the
+        # data set's index, or its name; or None if we're not in a test
+        methods = []
+        for match in TestAtCursor.function_regex.finditer(text):
+            # the docblock and attributes are between the end of the
+            # previous statement and the function keyword
+            boundary = max(text.rfind('}', 0, match.start()), text.rfind(';', 0, match.start()), text.rfind('{', 0, match.start()))
+            methods.append([match.group(1), match.start(), text[boundary + 1:match.start()]])
+
+        enclosing = None
+        for method in methods:
+            if method[1] <= point:
+                enclosing = method
+        if enclosing is None:
+            return None
+        if TestAtCursor.isTest(enclosing):
+            return (enclosing[0], None)
+
+        # are we inside one of the test's data providers?
+        for method in methods:
+            if not TestAtCursor.isTest(method):
+                continue
+            for names in TestAtCursor.provider_regex.findall(method[2]):
+                if enclosing[0] in names:
+                    body = text.find('{', enclosing[1])
+                    if body < 0 or body >= point:
+                        return (method[0], None)
+                    return (method[0], TestAtCursor.dataSet(text[body + 1:point]))
+        return None
 
     @staticmethod
-    def find(top_folder, filename):
-        Msgs.debug_msg('Searching ProjectFiles cache for ' + filename)
-        if top_folder not in ProjectFiles.files:
-            Msgs.debug_msg('-- no cache for ' + top_folder)
+    def isTest(method):
+        return method[0].startswith('test') or TestAtCursor.test_regex.search(method[2]) is not None
+
+    @staticmethod
+    def dataSet(body):
+        # providers either return an array of rows, or yield one row at
+        # a time; the rows can have names, and the ones that don't are
+        # numbered from zero
+        depth = 0
+        in_return = False
+        array_depth = None
+        row = 0
+        key = None
+        in_yield = False
+        yields = 0
+        yield_key = None
+        # the last two tokens that we have seen
+        previous = None
+        before = None
+        for match in TestAtCursor.token_regex.finditer(body):
+            kind = match.lastgroup
+            if kind == 'comment':
+                continue
+            if kind == 'word' and match.group().lower() in ('return', 'yield'):
+                kind = match.group().lower()
+
+            if kind == 'return' and depth == 0:
+                in_return = True
+            elif kind == 'yield':
+                if in_yield and yield_key is None:
+                    yields += 1
+                in_yield = True
+                yield_key = None
+            elif kind == 'open':
+                depth += 1
+                if in_return and array_depth is None and match.group() != '{':
+                    array_depth = depth
+            elif kind == 'close':
+                depth -= 1
+            elif kind == 'comma' and depth == array_depth:
+                if key is None:
+                    row += 1
+                key = None
+            elif kind == 'semicolon' and depth == 0:
+                in_return = False
+            elif kind == 'arrow' and before is not None:
+                # a key comes straight after the start of its row
+                if depth == array_depth and before[0] in ('open', 'comma'):
+                    key = TestAtCursor.dataSetKey(previous[1])
+                elif before[0] == 'yield':
+                    yield_key = TestAtCursor.dataSetKey(previous[1])
+            before = previous
+            previous = (kind, match)
+
+        if in_yield:
+            if yield_key is not None:
+                return yield_key
+            return yields
+        if array_depth is None or depth < array_depth:
             return None
+        if key is not None:
+            return key
+        return row
 
-        result = [x for x in ProjectFiles.files[top_folder] if x.endswith(filename)]
-        if len(result) == 0:
-            Msgs.debug_msg('-- none found')
+    @staticmethod
+    def dataSetKey(match):
+        if match is None:
             return None
-        Msgs.debug_msg('-- found ' + result[0])
-        return result[0]
+        if match.lastgroup == 'string':
+            return match.group()[1:-1].replace('\\' + match.group()[0], match.group()[0])
+        if match.group().isdigit():
+            return int(match.group())
+        return None
 
     @staticmethod
-    def expired(when):
-        if when is None:
-            return True
-        if when < ProjectFiles.last_built_time:
-            return True
-        return False
+    def filterFor(classname, method, data_set):
+        name = TestResults.escape(classname + '::' + method)
+        if data_set is None:
+            return '/^' + name + '\\b/'
+        return '/^' + name + TestResults.escape(TestAtCursor.dataSetName(data_set)) + '$/'
+
+    @staticmethod
+    def dataSetName(data_set):
+        # this is how PHPUnit names data sets
+        if isinstance(data_set, int):
+            return ' with data set #' + str(data_set)
+        return ' with data set "' + data_set + '"'
 
 
 class ActiveFile:
     def is_test_buffer(self):
         Msgs.debug_msg('Is buffer a file containing tests?')
         filename = self.file_name()
-        if not os.path.isfile(filename):
+        if not FolderListings.isFile(filename):
             Msgs.debug_msg("-- Buffer is not a real file; unsaved new buffer?")
             return False
         filename = os.path.splitext(filename)[0]
@@ -483,7 +3091,7 @@ class ActiveFile:
     def is_tests_buffer(self):
         Msgs.debug_msg('Is buffer a file containing a testsuite?')
         filename = self.file_name()
-        if not os.path.isfile(filename):
+        if not FolderListings.isFile(filename):
             Msgs.debug_msg("-- Buffer is not a real file; unsaved new buffer?")
             return False
         filename = os.path.splitext(filename)[0]
@@ -496,7 +3104,7 @@ class ActiveFile:
     def is_phpunitxml(self):
         # is this a phpunit.xml file?
         filename = self.file_name()
-        if not os.path.isfile(filename):
+        if not FolderListings.isFile(filename):
             Msgs.debug_msg("Buffer is not phpunit.xml; is not a real file")
             return False
         filename = os.path.basename(filename)
@@ -520,14 +3128,19 @@ class ActiveFile:
 
         return None
 
+    def top_folder(self):
+        path = ProjectRoots.find(self.window_folders(), os.path.dirname(self.file_name()))
+        Msgs.debug_msg("Top folder for this project is: %s", path)
+        return path
+
     def findPhpunitXml(self, search_from):
         Msgs.debug_msg("Looking for phpunit.xml of some kind")
-        Msgs.debug_msg("Project's top folder is: " + self.top_folder())
+        top_folder = self.top_folder()
 
         # what are we looking for?
         files_to_find = Prefs.phpunit_xml_aliases
 
-        return FindFiles.find(self.top_folder(), search_from, files_to_find)
+        return FindFiles.find(top_folder, search_from, files_to_find, 'xml')
 
     def error_message(self, message):
         sublime.status_message(message)
@@ -562,10 +3175,10 @@ class ActiveView(ActiveFile):
             Msgs.debug_msg("Buffer is a PHP buffer")
             return True
         # is this a PHP buffer?
-        if re.search('.+\PHP.tmLanguage', self.view.settings().get('syntax')):
+        if re.search(r'.+[\\/]PHP\.tmLanguage', self.view.settings().get('syntax')):
             return True
         # if we get here, we're not sure what else to try
-        Msgs.debug_msg("Buffer is not a PHP buffer; extension is: " + ext + "; syntax is: " + self.view.settings().get('syntax'))
+        Msgs.debug_msg("Buffer is not a PHP buffer; extension is: %s; syntax is: %s", ext, self.view.settings().get('syntax'))
         return False
 
     def has_project_open(self):
@@ -577,34 +3190,8 @@ class ActiveView(ActiveFile):
     def file_name(self):
         return self.view.file_name()
 
-    def top_folder(self):
-        # have we done this before?
-        if hasattr(self, 'top_folder_path'):
-            return self.top_folder_path
-
-        folders = self.view.window().folders()
-        path = os.path.dirname(self.file_name())
-        oldpath = ''
-        while not path in folders and path != oldpath and not self.top_level_folder_hints(path):
-            oldpath = path
-            path = os.path.dirname(path)
-        if path == oldpath:
-            # problem - we didn't find ourselves in the list of open folders
-            # fallback to using heuristics instead
-            path = os.path.dirname(self.file_name())
-            while not FindFiles.reachedTopLevelFolders(oldpath, path):
-                oldpath = path
-                path = os.path.dirname(path)
-        Msgs.debug_msg("Top folder for this project is: " + path)
-        self.top_folder_path = path
-        return path
-
-    def top_level_folder_hints(self, folder):
-        hints = Prefs.folder_search_hints
-        for hint in hints:
-            if os.path.exists(os.path.join(folder, hint)):
-                return True
-        return False
+    def window_folders(self):
+        return self.view.window().folders()
 
     def find_tested_file(self):
         Msgs.debug_msg("Looking for tested file")
@@ -616,7 +3203,7 @@ class ActiveView(ActiveFile):
 
         filename = fq_classname + '.php'
 
-        Msgs.debug_msg("Looking for tested file: " + os.path.basename(filename))
+        Msgs.debug_msg("Looking for tested file: %s", os.path.basename(filename))
 
         files_to_find = []
         files_to_find.append(filename)
@@ -626,8 +3213,13 @@ class ActiveView(ActiveFile):
         if filename[-8:] == 'Test.php':
             filename = filename[:-8] + '.php'
 
+        # do we already know where this class lives?
+        path = PhpSymbols.findTestedClass(self.top_folder(), self.determine_php_class_name())
+        if path is not None:
+            return [path, fq_classname]
+
         path_to_search = os.path.dirname(self.file_name())
-        path = FindFiles.find(self.top_folder(), path_to_search, files_to_find)
+        path = FindFiles.find(self.top_folder(), path_to_search, files_to_find, 'tested')
         if path is None:
             return None
 
@@ -640,7 +3232,7 @@ class ActiveView(ActiveFile):
             Msgs.debug_msg("I don't know what the classname is :(")
             return None
 
-        Msgs.debug_msg("classname is: " + classname)
+        Msgs.debug_msg("classname is: %s", classname)
 
         classname = classname + 'Test'
         filename = classname + '.php'
@@ -650,10 +3242,15 @@ class ActiveView(ActiveFile):
         files_to_find.append(os.path.basename(filename))
         files_to_find.append(os.path.basename(self.view.file_name())[:-4] + 'Test.php')
 
-        Msgs.debug_msg("Looking for test files: " + ', '.join(files_to_find))
+        Msgs.debug_msg("Looking for test files: %s", ', '.join(files_to_find))
+
+        # do we already know where the test class lives?
+        path = PhpSymbols.findTestClass(self.top_folder(), self.determine_php_class_name())
+        if path is not None:
+            return [path, classname]
 
         path_to_search = os.path.dirname(self.file_name())
-        path = FindFiles.find(self.top_folder(), path_to_search, files_to_find)
+        path = FindFiles.find(self.top_folder(), path_to_search, files_to_find, 'test')
         if path is None:
             return None
 
@@ -672,8 +3269,17 @@ class ActiveView(ActiveFile):
         path = path + classname
         return path
 
+    def determine_php_class_name(self):
+        namespace = self.extract_namespace()
+        classname = self.extract_classname()
+        if classname is None:
+            return None
+        if len(namespace) > 0:
+            return namespace + '\\' + classname
+        return classname
+
     def extract_namespace(self):
-        namespaces = self.view.find_all("namespace ([A-Za-z0-9_\\\]+);")
+        namespaces = self.view.find_all(r"namespace ([A-Za-z0-9_\\]+);")
         if namespaces is None or len(namespaces) == 0:
             return ''
         for namespace in namespaces:
@@ -706,6 +3312,9 @@ class ActiveWindow(ActiveFile):
 
         self._file_name = filename
 
+    def window_folders(self):
+        return self.window.folders()
+
     def is_php_buffer(self):
         ext = os.path.splitext(self.file_name())[1]
         if ext == '.php':
@@ -713,8 +3322,107 @@ class ActiveWindow(ActiveFile):
         return False
 
 
+class ViewResolution(ActiveView):
+    # everything that the commands need to know about a view
+    #
+    # each command used to work all of this out for itself, every time
+    # the context menu was opened; now the first command to ask does the
+    # work, and all the others share the answers
+    resolutions = {}
+
+    def __init__(self, view):
+        self.view = view
+        self.results = {}
+        self.ready = False
+        self.pending = False
+
+    @staticmethod
+    def forView(view):
+        # the answers can change if the buffer is edited, saved under a
+        # new name, or if the ProjectFiles cache has changed
+        key = (view.file_name(), view.change_count(), ProjectFiles.last_built_time)
+        entry = ViewResolution.resolutions.get(view.id())
+        if entry is None or entry[0] != key:
+            entry = (key, ViewResolution(view))
+            ViewResolution.resolutions[view.id()] = entry
+        return entry[1]
+
+    @staticmethod
+    def forget(view):
+        ViewResolution.resolutions.pop(view.id(), None)
+
+    def resolve(self, name, method):
+        if name not in self.results:
+            self.results[name] = method()
+        return self.results[name]
+
+    def is_php(self):
+        return self.resolve('is_php', self.is_php_buffer)
+
+    def is_test(self):
+        return self.resolve('is_test', self.is_test_buffer)
+
+    def is_tests(self):
+        return self.resolve('is_tests', self.is_tests_buffer)
+
+    def is_xml(self):
+        return self.resolve('is_xml', self.is_phpunitxml)
+
+    def test_file(self):
+        return self.resolve('test_file', self.find_test_file)
+
+    def tested_file(self):
+        return self.resolve('tested_file', self.find_tested_file)
+
+    def file_to_test(self):
+        # which file do we hand to PHPUnit?
+        if self.is_test() or self.is_tests():
+            return self.file_name()
+        test_file = self.test_file()
+        if test_file is None:
+            return None
+        return test_file[0]
+
+    def config(self):
+        return self.resolve('config', self.find_config)
+
+    def find_config(self):
+        filename = self.file_to_test()
+        if filename is None:
+            filename = self.file_name()
+        return self.findPhpunitXml(filename)
+
+    def is_resolved(self):
+        # ST2's API can only be used from the main thread, so there we
+        # have no choice but to do the work while the user waits
+        if Prefs.st2:
+            self.resolve_all()
+        elif not self.ready:
+            self.resolve_in_background()
+        return self.ready
+
+    def resolve_in_background(self):
+        if self.ready or self.pending:
+            return
+        self.pending = True
+        Background.run(self.resolve_all)
+
+    @Msgs.span("ViewResolution.resolve_all")
+    def resolve_all(self):
+        if self.ready:
+            return
+
+        if self.file_name() is not None and self.has_project_open() and self.is_php():
+            self.top_folder()
+            if self.is_test():
+                self.tested_file()
+            self.config()
+        self.ready = True
+
+
 class PhpunitTextBase(sublime_plugin.TextCommand, ActiveView):
     last_checked_enabled = None
+    checked_resolution = None
 
     def run(self, args):
         print('Not implemented')
@@ -727,15 +3435,25 @@ class PhpunitTextBase(sublime_plugin.TextCommand, ActiveView):
             active_group = (active_group + 1) % 2
             if active_group >= num_groups:
                 active_group = num_groups - 1
-            Msgs.debug_msg("switching to group " + str(active_group))
+            Msgs.debug_msg("switching to group %s", active_group)
             self.view.window().focus_group(active_group)
 
+    def resolution(self):
+        return ViewResolution.forView(self.view)
+
     def enabled_checked(self):
         self.last_checked_enabled = datetime.datetime.now()
+        # if the answers are still being worked out, we need to check
+        # again next time
+        self.checked_resolution = self.resolution()
+        if not self.checked_resolution.ready:
+            self.checked_resolution = None
 
     def needs_enabling(self):
         if self.last_checked_enabled is None or ProjectFiles.expired(self.last_checked_enabled):
             return True
+        if self.checked_resolution is not self.resolution():
+            return True
         return False
 
 
@@ -743,24 +3461,23 @@ class PhpunitRunTestsCommand(PhpunitTextBase):
     path_to_config = None
     file_to_test = None
 
+    @Msgs.span("PhpunitRunTestsClassCommand.run")
     def run(self, edit):
-        Msgs.operation = "PhpunitRunTestsClassCommand.run"
-
         cmd = PhpunitCommand(self.view.window(), edit)
-        cmd.run(self.top_folder(), self.path_to_config, self.file_to_test)
+        cmd.run(self.resolution().top_folder(), self.path_to_config, self.file_to_test)
 
         return None
 
+    @Msgs.span("PhpunitRunTestsClassCommand.description")
     def description(self):
-        Msgs.operation = "PhpunitRunTestsClassCommand.description"
         if self.file_to_test is None:
             return self.cannot_find_test_file()
         if self.path_to_config is None:
             return self.cannot_find_xml()
         return 'Run Tests ...'
 
+    @Msgs.span("PhpunitRunTestsClassCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitRunTestsClassCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
@@ -769,23 +3486,22 @@ class PhpunitRunTestsCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
+            return False
+        if not r.is_resolved():
             return False
 
-        if self.is_test_buffer() or self.is_tests_buffer():
-            test_file_to_open = [self.view.file_name()]
-        else:
-            test_file_to_open = self.find_test_file()
-
-        if test_file_to_open is None:
+        self.file_to_test = r.file_to_test()
+        if self.file_to_test is None:
             return False
 
-        self.file_to_test = test_file_to_open[0]
-        self.path_to_config = self.findPhpunitXml(self.file_to_test)
+        self.path_to_config = r.config()
         if self.path_to_config is None:
             return False
         return True
 
+    @Msgs.span("PhpunitRunTestsClassCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -794,20 +3510,84 @@ class PhpunitRunTestsCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitRunTestsClassCommand.is_visible"
         Msgs.debug_msg('called')
 
-        if self.is_php_buffer() and os.path.exists(self.view.file_name()):
+        r = self.resolution()
+        if r.is_php() and r.is_resolved() and FolderListings.exists(self.view.file_name()):
             return True
         return False
 
 
+class PhpunitRunTestMethodCommand(PhpunitTextBase):
+    path_to_config = None
+    test_at_cursor = None
+
+    @Msgs.span("PhpunitRunTestMethodCommand.run")
+    def run(self, edit):
+        method, data_set = self.test_at_cursor
+        classname = self.determine_php_class_name()
+        cmd = PhpunitCommand(self.view.window(), edit)
+        cmd.run(self.resolution().top_folder(), self.path_to_config, self.file_name(), test_filter=TestAtCursor.filterFor(classname, method, data_set))
+
+        return None
+
+    def description(self):
+        if self.test_at_cursor is None:
+            return 'Run This Test ...'
+        method, data_set = self.test_at_cursor
+        if data_set is None:
+            return 'Run Test ' + method + ' ...'
+        return 'Run Test ' + method + TestAtCursor.dataSetName(data_set) + ' ...'
+
+    @Msgs.span("PhpunitRunTestMethodCommand.is_enabled")
+    def is_enabled(self):
+        Msgs.debug_msg('called')
+        self.enabled_checked()
+
+        self.test_at_cursor = None
+        self.path_to_config = None
+
+        if not self.has_project_open():
+            return False
+        r = self.resolution()
+        if not r.is_php():
+            return False
+        if not r.is_resolved():
+            return False
+        if not r.is_test():
+            return False
+
+        self.path_to_config = r.config()
+        if self.path_to_config is None:
+            return False
+        if len(self.view.sel()) == 0:
+            return False
+
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        self.test_at_cursor = TestAtCursor.find(text, self.view.sel()[0].begin())
+        return self.test_at_cursor is not None
+
+    @Msgs.span("PhpunitRunTestMethodCommand.is_visible")
+    def is_visible(self):
+        # has the user switched off context-menu support?
+        if not Prefs.context_menu:
+            return False
+
+        # the caret moves without changing the buffer, so we always
+        # have to look again
+        self.is_enabled()
+
+        Msgs.debug_msg('called')
+
+        return self.test_at_cursor is not None
+
+
 class PhpunitOpenTestClassCommand(PhpunitTextBase):
     file_to_open = None
 
+    @Msgs.span("PhpunitOpenTestClassCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitOpenTestClassCommand.run"
 
         # where will we open the file?
         self.toggle_active_group()
@@ -818,8 +3598,8 @@ class PhpunitOpenTestClassCommand(PhpunitTextBase):
     def description(self):
         return 'Open Test Class'
 
+    @Msgs.span("PhpunitOpenTestClassCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitOpenTestClassCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
@@ -827,16 +3607,20 @@ class PhpunitOpenTestClassCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
+            return False
+        if r.is_test() or r.is_tests():
             return False
-        if self.is_test_buffer() or self.is_tests_buffer():
+        if not r.is_resolved():
             return False
-        path = self.find_test_file()
+        path = r.test_file()
         if path is None:
             return False
         self.file_to_open = path[0]
         return True
 
+    @Msgs.span("PhpunitOpenTestClassCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -845,7 +3629,6 @@ class PhpunitOpenTestClassCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitOpenTestClassCommand.is_visible"
         Msgs.debug_msg('called')
 
         if self.file_to_open is not None:
@@ -856,9 +3639,9 @@ class PhpunitOpenTestClassCommand(PhpunitTextBase):
 class PhpunitOpenClassBeingTestedCommand(PhpunitTextBase):
     file_to_open = None
 
+    @Msgs.span("PhpunitOpenClassBeingTestedCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitOpenClassBeingTestedCommand.run"
 
         # where will we open the file?
         self.toggle_active_group()
@@ -869,8 +3652,8 @@ class PhpunitOpenClassBeingTestedCommand(PhpunitTextBase):
     def description(self):
         return 'Open Class Being Tested'
 
+    @Msgs.span("PhpunitOpenClassBeingTestedCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitOpenClassBeingTestedCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
@@ -878,18 +3661,22 @@ class PhpunitOpenClassBeingTestedCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
             return False
-        if not self.is_test_buffer():
+        if not r.is_test():
             return False
-        if self.is_tests_buffer():
+        if r.is_tests():
             return False
-        path = self.find_tested_file()
+        if not r.is_resolved():
+            return False
+        path = r.tested_file()
         if path is None:
             return False
         self.file_to_open = path[0]
         return True
 
+    @Msgs.span("PhpunitOpenClassBeingTestedCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -898,7 +3685,6 @@ class PhpunitOpenClassBeingTestedCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitOpenClassBeingTestedCommand.is_visible"
         Msgs.debug_msg('called')
 
         if self.file_to_open is not None:
@@ -909,9 +3695,9 @@ class PhpunitOpenClassBeingTestedCommand(PhpunitTextBase):
 class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
     file_to_open = None
 
+    @Msgs.span("PhpunitToggleClassTestClassCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitToggleClassTestClassCommand.run"
 
         # where will we open the file?
         self.toggle_active_group()
@@ -919,8 +3705,8 @@ class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
         # open the file
         self.view.window().open_file(self.file_to_open)
 
+    @Msgs.span("PhpunitToggleClassTestClassCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitToggleClassTestClassCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
@@ -928,12 +3714,15 @@ class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
+            return False
+        if not r.is_resolved():
             return False
-        if self.is_test_buffer() or self.is_tests_buffer():
-            file_to_open = self.find_tested_file()
+        if r.is_test() or r.is_tests():
+            file_to_open = r.tested_file()
         else:
-            file_to_open = self.find_test_file()
+            file_to_open = r.test_file()
 
         if file_to_open is None:
             return False
@@ -941,6 +3730,7 @@ class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
         self.file_to_open = file_to_open[0]
         return True
 
+    @Msgs.span("PhpunitToggleClassTestClassCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -949,7 +3739,6 @@ class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitToggleClassTestClassCommand.is_visible"
         Msgs.debug_msg('called')
 
         if self.file_to_open is not None:
@@ -963,9 +3752,9 @@ class PhpunitToggleClassTestClassCommand(PhpunitTextBase):
 class PhpunitOpenPhpunitXmlCommand(PhpunitTextBase):
     file_to_open = None
 
+    @Msgs.span("PhpunitOpenPhpunitXmlCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitOpenPhpunitXmlCommand.run"
 
         # where will we open the file?
         self.toggle_active_group()
@@ -976,6 +3765,7 @@ class PhpunitOpenPhpunitXmlCommand(PhpunitTextBase):
     def description(self):
         return 'Open phpunit.xml'
 
+    @Msgs.span("PhpunitOpenPhpunitXmlCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -984,15 +3774,14 @@ class PhpunitOpenPhpunitXmlCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitOpenPhpunitXmlCommand.is_visible"
         Msgs.debug_msg('called')
 
         if self.file_to_open is not None:
             return True
         return False
 
+    @Msgs.span("PhpunitOpenPhpunitXmlCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitOpenPhpunitXmlCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
@@ -1000,19 +3789,14 @@ class PhpunitOpenPhpunitXmlCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
             return False
-        if self.is_phpunitxml():
+        if r.is_xml():
             return False
-        if self.is_test_buffer() or self.is_tests_buffer():
-            filename = self.view.file_name()
-        else:
-            filename = self.find_test_file()
-            if filename is not None:
-                filename = filename[0]
-            else:
-                filename = self.view.file_name()
-        path = self.findPhpunitXml(filename)
+        if not r.is_resolved():
+            return False
+        path = r.config()
         if path is None:
             return False
         self.file_to_open = path
@@ -1020,22 +3804,23 @@ class PhpunitOpenPhpunitXmlCommand(PhpunitTextBase):
 
 
 class PhpunitRunThisPhpunitXmlCommand(PhpunitTextBase):
+    @Msgs.span("PhpunitRunThisPhpunitXmlCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitRunThisPhpunitXmlCommand.run"
         phpunit_xml_file = self.file_name()
         cmd = PhpunitCommand(self.view.window(), edit)
-        cmd.run(self.top_folder(), phpunit_xml_file)
+        cmd.run(self.resolution().top_folder(), phpunit_xml_file)
 
+    @Msgs.span("PhpunitRunThisPhpunitXmlCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitRunThisPhpunitXmlCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
         if not self.has_project_open():
             return False
-        return self.is_phpunitxml()
+        return self.resolution().is_xml()
 
+    @Msgs.span("PhpunitRunThisPhpunitXmlCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -1044,12 +3829,11 @@ class PhpunitRunThisPhpunitXmlCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitRunThisPhpunitXmlCommand.is_visible"
         Msgs.debug_msg('called')
 
         if not self.has_project_open():
             return False
-        return self.is_phpunitxml()
+        return self.resolution().is_xml()
 
     def description(self, paths=[]):
         return 'Run Using This XML File...'
@@ -1058,42 +3842,38 @@ class PhpunitRunThisPhpunitXmlCommand(PhpunitTextBase):
 class PhpunitRunAllTestsCommand(PhpunitTextBase):
     path_to_config = None
 
+    @Msgs.span("PhpunitRunAllTestsCommand.run")
     def run(self, edit):
         self.edit = edit
-        Msgs.operation = "PhpunitRunAllTestsCommand.run"
         cmd = PhpunitCommand(self.view.window(), edit)
-        cmd.run(self.top_folder(), self.path_to_config)
+        cmd.run(self.resolution().top_folder(), self.path_to_config)
 
     def description(self):
         return 'Run All Unit Tests...'
 
+    @Msgs.span("PhpunitRunAllTestsCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitRunAllTestsCommand.is_enabled"
         Msgs.debug_msg('called')
         self.enabled_checked()
 
         self.path_to_config = None
         if not self.has_project_open():
             return False
-        if not self.is_php_buffer():
+        r = self.resolution()
+        if not r.is_php():
             return False
-        if self.is_phpunitxml():
+        if r.is_xml():
             return False
-        if self.is_test_buffer() or self.is_tests_buffer():
-            filename = self.view.file_name()
-        else:
-            filename = self.find_test_file()
-            if filename is not None:
-                filename = filename[0]
-            else:
-                filename = self.view.file_name()
-        path = self.findPhpunitXml(filename)
+        if not r.is_resolved():
+            return False
+        path = r.config()
         if path is None:
             return False
 
         self.path_to_config = path
         return True
 
+    @Msgs.span("PhpunitRunAllTestsCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -1102,7 +3882,6 @@ class PhpunitRunAllTestsCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitRunAllTestsCommand.is_visible"
         Msgs.debug_msg('called')
 
         if self.path_to_config is not None:
@@ -1110,9 +3889,31 @@ class PhpunitRunAllTestsCommand(PhpunitTextBase):
         return False
 
 
+class PhpunitRunAllTestsInParallelCommand(PhpunitRunAllTestsCommand):
+    @Msgs.span("PhpunitRunAllTestsInParallelCommand.run")
+    def run(self, edit):
+        self.edit = edit
+        cmd = ParallelPhpunitCommand(self.view.window(), edit)
+        cmd.run(self.resolution().top_folder(), self.path_to_config)
+
+    def description(self):
+        return 'Run All Unit Tests In Parallel...'
+
+
+class PhpunitBuildCoverageMapCommand(PhpunitRunAllTestsCommand):
+    @Msgs.span("PhpunitBuildCoverageMapCommand.run")
+    def run(self, edit):
+        self.edit = edit
+        cmd = PhpunitCommand(self.view.window(), edit)
+        cmd.run(self.resolution().top_folder(), self.path_to_config, coverage=True)
+
+    def description(self):
+        return 'Build Coverage Map...'
+
+
 class PhpunitNotAvailableCommand(PhpunitTextBase):
+    @Msgs.span("PhpunitNotAvailableCommand.is_visible")
     def is_visible(self):
-        Msgs.operation = "PhpunitNotAvailableCommand.is_visible"
         Msgs.debug_msg('called')
 
         # has the user switched off context-menu support?
@@ -1121,72 +3922,112 @@ class PhpunitNotAvailableCommand(PhpunitTextBase):
 
         if not self.has_project_open():
             return True
-        if self.is_php_buffer():
+        r = self.resolution()
+        if r.is_php():
             return False
-        if self.is_phpunitxml():
+        if r.is_xml():
             return False
         return True
 
+    @Msgs.span("PhpunitNotAvailableCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitNotAvailableCommand.is_enabled"
         Msgs.debug_msg('called')
 
         return False
 
+    @Msgs.span("PhpunitNotAvailableCommand.description")
     def description(self):
-        Msgs.operation = "PhpunitNotAvailableCommand.description"
         Msgs.debug_msg('called')
 
         if not self.has_project_open():
             return self.not_in_project()
-        if not self.is_php_buffer():
+        if not self.resolution().is_php():
             return self.not_php_file(self.view.settings().get('syntax'))
         return self.cannot_find_xml()
 
 
+class PhpunitResolvingCommand(PhpunitTextBase):
+    @Msgs.span("PhpunitResolvingCommand.is_visible")
+    def is_visible(self):
+        Msgs.debug_msg('called')
+
+        # has the user switched off context-menu support?
+        if not Prefs.context_menu:
+            return False
+
+        if not self.has_project_open():
+            return False
+        r = self.resolution()
+        if not r.is_php():
+            return False
+        if r.is_resolved():
+            return False
+        return True
+
+    def is_enabled(self):
+        return False
+
+    def description(self):
+        return 'Resolving ...'
+
+
 class PhpunitContextMenuDisabledCommand(PhpunitTextBase):
+    @Msgs.span("PhpunitContextMenuDisabledCommand.is_visible")
     def is_visible(self):
-        Msgs.operation = "PhpunitContextMenuDisabledCommand.is_visible"
         Msgs.debug_msg('called')
 
         if not Prefs.context_menu:
             return True
         return False
 
+    @Msgs.span("PhpunitContextMenuDisabledCommand.is_enabled")
     def is_enabled(self):
-        Msgs.operation = "PhpunitContextMenuDisabledCommand.is_enabled"
         Msgs.debug_msg('called')
 
         return False
 
+    @Msgs.span("PhpunitContextMenuDisabledCommand.description")
     def description(self):
-        Msgs.operation = "PhpunitContextMenuDisabledCommand.description"
         Msgs.debug_msg('called')
 
         return "Context menu has been disabled in prefs file"
 
 
 class PhpunitFlushCacheCommand(PhpunitTextBase):
+    @Msgs.span("PhpunitFlushCacheCommand.is_enabled")
     def is_enabled(self):
         if not self.needs_enabling():
             return False
 
-        Msgs.operation = "PhpunitFlushCacheCommand.is_enabled"
         Msgs.debug_msg('called')
 
         Prefs.load()
-        FoundFiles.removeCache()
-        ProjectFiles.buildFilesList(self.top_folder())
+        FolderListings.removeListings()
+        ProjectRoots.removeRoots()
+        top_folder = self.top_folder()
+        # there is no need to start again if we already have an index
+        # that the sweeps are keeping up to date, or one saved on disk,
+        # unless the settings that shape the index have changed
+        if ProjectFiles.isStale(top_folder):
+            ProjectFiles.rebuild(top_folder)
+        elif top_folder not in ProjectFiles.folders and not ProjectFiles.isBuilding(top_folder):
+            if not ProjectCache.loadIndex(top_folder):
+                FoundFiles.removeCacheFor(top_folder)
+                ProjectFiles.buildFilesList(top_folder)
 
-        # special case!!
-        #
-        # we call enabled_checked() AT THE END because it must have a
-        # timestamp no earlier than the time we rebuilt the ProjectFiles
-        # cache
         self.enabled_checked()
 
         return False
 
+    def needs_enabling(self):
+        # the ProjectFiles cache is now built in the background, and
+        # publishes its progress as it goes; if we used the default
+        # check here, every published slice would trigger a new rebuild
+        if self.last_checked_enabled is None:
+            return True
+        return False
+
+    @Msgs.span("PhpunitFlushCacheCommand.is_visible")
     def is_visible(self):
         # has the user switched off context-menu support?
         if not Prefs.context_menu:
@@ -1195,7 +4036,6 @@ class PhpunitFlushCacheCommand(PhpunitTextBase):
         if self.needs_enabling():
             self.is_enabled()
 
-        Msgs.operation = "PhpunitFlushCacheCommand.is_visible"
         Msgs.debug_msg('called')
 
         return False
@@ -1207,8 +4047,8 @@ class PhpunitWindowBase(sublime_plugin.WindowCommand, ActiveWindow):
 
 
 class RunPhpunitOnXmlCommand(PhpunitWindowBase):
+    @Msgs.span("RunPhpunitOnXmlCommand.run")
     def run(self, paths=[]):
-        Msgs.operation = "RunPhpunitOnXmlCommand.run"
         Msgs.debug_msg('called')
 
         self.determine_filename(paths)
@@ -1216,14 +4056,14 @@ class RunPhpunitOnXmlCommand(PhpunitWindowBase):
         cmd = PhpunitCommand(self.window)
         cmd.run(self.top_folder(), filename)
 
+    @Msgs.span("RunPhpunitOnXmlCommand.is_enabled")
     def is_enabled(self, paths=[]):
-        Msgs.operation = "RunPhpunitOnXmlCommand.is_enabled"
         Msgs.debug_msg('called')
 
         return self.is_visible(paths)
 
+    @Msgs.span("RunPhpunitOnXmlCommand.is_visible")
     def is_visible(self, paths=[]):
-        Msgs.operation = "RunPhpunitOnXmlCommand.is_visible"
         Msgs.debug_msg('called')
 
         self.determine_filename(paths)
@@ -1233,52 +4073,268 @@ class RunPhpunitOnXmlCommand(PhpunitWindowBase):
         return 'Run PHPUnit Using This XML File...'
 
 
-class ActiveEvent(ActiveView):
-    def __init__(self, view):
-        self.view = view
+class PhpunitCancelTestsCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitCancelTestsCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        CommandBase.cancel(self.window)
+
+    def is_enabled(self, paths=[]):
+        return CommandBase.is_running_in(self.window)
+
+    def description(self, paths=[]):
+        return 'Cancel Running Tests'
+
+
+class PhpunitFlushFolderCacheCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitFlushFolderCacheCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        Prefs.load()
+        FolderListings.removeListings()
+        ProjectRoots.removeRoots()
+        top_folder = ViewResolution.forView(self.window.active_view()).top_folder()
+        if top_folder is not None:
+            ProjectFiles.rebuild(top_folder)
+
+    def is_enabled(self, paths=[]):
+        view = self.window.active_view()
+        return view is not None and view.file_name() is not None and len(self.window.folders()) > 0
+
+    def description(self, paths=[]):
+        return 'Flush Folder Cache'
+
+
+class PhpunitShowFailuresCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitShowFailuresCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        self.failures = TestResults.failures(self.window)
+        items = []
+        for result in self.failures:
+            # the first line of the message is the name of the test
+            lines = result.message.split('\n')
+            items.append([result.full_name(), lines[min(1, len(lines) - 1)]])
+        self.window.show_quick_panel(items, self.on_done)
+
+    def on_done(self, index):
+        if index < 0:
+            return
+        result = self.failures[index]
+        if result.failed_file is None:
+            return
+        self.window.open_file(result.failed_file + ':' + str(result.failed_line), sublime.ENCODED_POSITION)
+
+    def is_enabled(self, paths=[]):
+        return len(TestResults.failures(self.window)) > 0
+
+    def description(self, paths=[]):
+        return 'Show Test Failures...'
+
+
+class PhpunitRerunFailuresCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitRerunFailuresCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        folder, configfile, names = self.failed_tests()
+        if len(names) == 0:
+            return
+        cmd = PhpunitCommand(self.window)
+        cmd.run(folder, configfile, test_filter=TestResults.filterFor(names))
+
+    def failed_tests(self):
+        # the last run in this window tells us the most
+        last = TestResults.lastRun(self.window)
+        if last is not None:
+            return last[0], last[1], [x.full_name() for x in last[2] if x.is_failed()]
+
+        # otherwise, PHPUnit may have remembered for us
+        view = self.window.active_view()
+        if view is None or view.file_name() is None or not self.window.folders():
+            return None, None, []
+        r = ViewResolution.forView(view)
+        if not r.is_resolved() or r.config() is None:
+            return None, None, []
+        folder = r.top_folder()
+        return folder, r.config(), TestResults.failedInCache(folder, r.config())
+
+    def is_enabled(self, paths=[]):
+        return len(self.failed_tests()[2]) > 0
+
+    def description(self, paths=[]):
+        return 'Re-run Failed Tests'
+
+
+class PhpunitSlowestTestsCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitSlowestTestsCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        self.top_folder_for_durations = self.project_folder()
+        self.slowest = TestDurations.slowest(self.top_folder_for_durations)
+        items = []
+        for name, p50, p95, count in self.slowest:
+            items.append([name, "p50 %.3fs, p95 %.3fs, over %d run(s)" % (p50, p95, count)])
+        self.window.show_quick_panel(items, self.on_done)
+
+    def on_done(self, index):
+        if index < 0:
+            return
+        name = self.slowest[index][0]
+
+        # the last run tells us exactly where the test is
+        for result in TestResults.get(self.window):
+            if result.full_name() == name and result.filename is not None:
+                self.window.open_file(result.filename + ':' + str(result.line), sublime.ENCODED_POSITION)
+                return
+        filename = PhpSymbols.find(self.top_folder_for_durations, [name.split('::')[0]])
+        if filename is not None:
+            self.window.open_file(filename)
+
+    def project_folder(self):
+        last = TestResults.lastRun(self.window)
+        if last is not None:
+            return last[0]
+        view = self.window.active_view()
+        if view is None or view.file_name() is None or not self.window.folders():
+            return None
+        return ViewResolution.forView(view).top_folder()
+
+    def is_enabled(self, paths=[]):
+        folder = self.project_folder()
+        if folder is None:
+            return False
+        return len(TestDurations.get(folder)) > 0
+
+    def description(self, paths=[]):
+        return 'Slowest Tests...'
+
+
+class PhpunitShowResolutionStatsCommand(PhpunitWindowBase):
+    @Msgs.span("PhpunitShowResolutionStatsCommand.run")
+    def run(self, paths=[]):
+        Msgs.debug_msg('called')
+
+        output_view = CompatibilityOutputView('exec', self.window)
+        output_view.clear_output_view()
+        output_view.append_data(ResolutionStats.report())
+        output_view.show_output()
+
+    def description(self, paths=[]):
+        return 'Show Resolution Stats'
 
 
 class RunPhpunitOnSave(sublime_plugin.EventListener):
     def on_post_save(self, view):
+        # ST3 calls on_post_save_async() for us instead
+        if Prefs.st2:
+            self.run_on_save(view)
+
+    def on_post_save_async(self, view):
+        self.run_on_save(view)
+
+    def run_on_save(self, view):
         Msgs.debug_msg("on_post_save() called")
         # has the user switched this feature on?
         if not Prefs.run_on_save:
             return
         # has a viable buffer just been saved?
-        e = ActiveEvent(view)
-        if not self.is_enabled(e):
+        r = ViewResolution.forView(view)
+        r.resolve_all()
+        if not self.is_enabled(r):
             return
-        self.run(e)
+        self.run(r)
 
-    def run(self, e):
-        Msgs.operation = "PhpunitRunTestsClassCommand.run"
-
-        cmd = PhpunitCommand(e.view.window(), None)
-        cmd.run(self.top_folder(), self.path_to_config, self.file_to_test)
+    @Msgs.span("RunPhpunitOnSave.run")
+    def run(self, r):
+        RunScheduler.schedule(r.view.window(), r.top_folder(), self.path_to_config, self.file_to_test, self.covering_tests)
 
         return None
 
-    def is_enabled(self, e):
+    def is_enabled(self, r):
         self.file_to_test = None
         self.path_to_config = None
+        self.covering_tests = []
 
-        if not e.has_project_open():
+        if not r.has_project_open():
             return False
-        if not e.is_php_buffer():
+        if not r.is_php():
             return False
 
-        if e.is_test_buffer() or e.is_tests_buffer():
-            test_file_to_open = [e.view.file_name()]
-            tested_file_to_open = e.find_tested_file()
-        else:
-            test_file_to_open = e.find_test_file()
-            tested_file_to_open = [e.view.file_name()]
-
-        if test_file_to_open is None and tested_file_to_open is None:
+        self.path_to_config = r.config()
+        if self.path_to_config is None:
             return False
 
-        self.file_to_test = test_file_to_open[0]
-        self.path_to_config = e.findPhpunitXml(self.file_to_test)
-        if self.path_to_config is None:
+        # if we know which tests run this code, those are the ones
+        # that we want
+        if Prefs.coverage_impact and not r.is_test() and not r.is_tests():
+            self.covering_tests = CoverageMap.testsFor(r.top_folder(), r.file_name())
+            if len(self.covering_tests) > 0:
+                return True
+
+        self.file_to_test = r.file_to_test()
+        if self.file_to_test is None:
             return False
-        return True
\ No newline at end of file
+        return True
+
+
+class ProjectFilesUpdater(sublime_plugin.EventListener):
+    # keeps the ProjectFiles cache up to date between sweeps, for the
+    # files that the user is working with
+
+    def on_post_save(self, view):
+        self.add_file(view)
+        if view.file_name() is not None:
+            Background.run(functools.partial(PhpSymbols.fileSaved, view.file_name()))
+
+    def on_load(self, view):
+        self.add_file(view)
+
+    def on_close(self, view):
+        ViewResolution.forget(view)
+
+        filename = view.file_name()
+        if filename is None or os.path.exists(filename):
+            return
+        Background.run(functools.partial(ProjectFiles.removeFile, filename))
+
+    def add_file(self, view):
+        filename = view.file_name()
+        if filename is None:
+            return
+        Background.run(functools.partial(ProjectFiles.addFile, filename))
+
+
+class ViewResolutionListener(sublime_plugin.EventListener):
+    # works out the answers for a view in the background, so that they
+    # are ready before the user opens the context menu
+    #
+    # ST2 has no async events, and its API cannot be used from other
+    # threads, so there the commands still work it out when asked
+
+    def on_activated_async(self, view):
+        self.resolve(view)
+
+    def on_load_async(self, view):
+        self.resolve(view)
+
+    def on_post_save_async(self, view):
+        self.resolve(view)
+
+    def on_modified_async(self, view):
+        # wait until the user stops typing
+        change_count = view.change_count()
+        sublime.set_timeout_async(functools.partial(self.resolve_if_unchanged, view, change_count), 500)
+
+    def resolve_if_unchanged(self, view, change_count):
+        if view.change_count() == change_count:
+            self.resolve(view)
+
+    def resolve(self, view):
+        if view.file_name() is None or view.window() is None:
+            return
+        ViewResolution.forView(view).resolve_all()